@@ -0,0 +1,234 @@
+# Audio decoding into NumPy arrays.
+#
+# AudioSegment.from_mp3 starts one ffmpeg process per file and
+# round-trips through temporary WAV files. Here, files are decoded
+# in-process by libsndfile (via soundfile, when it supports MP3), or
+# else by ffmpeg writing raw PCM: straight into a pipe for a single
+# file, and for many files, one ffmpeg process per batch.
+
+from concurrent.futures import ThreadPoolExecutor
+from pydub import AudioSegment
+import numpy as np
+import os
+import re
+import subprocess
+import tempfile
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+batch_size = 32  # files decoded per ffmpeg process
+channel_layouts = {"mono": 1, "stereo": 2}
+
+
+def in_process(file_name):
+    """ Whether soundfile can decode this file without ffmpeg.
+
+    :type file_name: string
+    :param file_name: Path of the audio file
+
+    :raises: N/A
+
+    :rtype: bool
+    """
+    if soundfile is None:
+        return False
+    extension = os.path.splitext(file_name)[1][1:].upper()
+    return extension in soundfile.available_formats()
+
+
+def decode_in_process(file_name):
+    """ Decodes a file with libsndfile.
+
+    :type file_name: string
+    :param file_name: Path of the audio file
+
+    :raises: RuntimeError if the file can't be decoded
+
+    :rtype: tuple
+    """
+    frames, frame_rate = soundfile.read(file_name, dtype="int16", always_2d=True)
+    return frames, frame_rate
+
+
+def parse_output_formats(log):
+    """ Reads the frame rate and channel count of each output
+    from ffmpeg's log.
+
+    :type log: string
+    :param log: What ffmpeg wrote to stderr
+
+    :raises: ValueError if an output's format can't be found
+
+    :rtype: list
+    """
+    formats = []
+    for output in re.split(r"^Output #\d+", log, flags=re.M)[1:]:
+        match = re.search(r"Audio: pcm_s16le.*?, (\d+) Hz, ([^,]+)", output)
+        if match is None:
+            raise ValueError(f"Couldn't find the output format in:\n{output}")
+        layout = match.group(2).strip()
+        if layout in channel_layouts:
+            channels = channel_layouts[layout]
+        else:
+            channels = int(re.match(r"(\d+)", layout).group(1))
+        formats.append((int(match.group(1)), channels))
+    return formats
+
+
+def run_ffmpeg(command):
+    """ Runs ffmpeg, returning its stdout and log.
+
+    :type command: list
+    :param command: Arguments after the ffmpeg executable
+
+    :raises: RuntimeError if ffmpeg fails
+
+    :rtype: tuple
+    """
+    process = subprocess.run(
+        [AudioSegment.converter, "-hide_banner", "-nostdin"] + command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    log = process.stderr.decode(errors="replace")
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed:\n{log}")
+    return process.stdout, log
+
+
+def decode_with_ffmpeg(file_name):
+    """ Decodes a single file with ffmpeg, piping raw PCM back
+    instead of going through temporary files.
+
+    :type file_name: string
+    :param file_name: Path of the audio file
+
+    :raises: RuntimeError if ffmpeg fails
+
+    :rtype: tuple
+    """
+    pcm, log = run_ffmpeg(
+        ["-i", file_name, "-vn", "-acodec", "pcm_s16le", "-f", "s16le", "pipe:1"]
+    )
+    frame_rate, channels = parse_output_formats(log)[0]
+    return np.frombuffer(pcm, dtype=np.int16).reshape(-1, channels), frame_rate
+
+
+def decode_batch_with_ffmpeg(file_names):
+    """ Decodes several files with a single ffmpeg process.
+
+    :type file_names: list
+    :param file_names: Paths of the audio files
+
+    :raises: RuntimeError if ffmpeg fails
+
+    :rtype: list
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        command = []
+        for file_name in file_names:
+            command += ["-i", file_name]
+        raw_names = []
+        for i in range(len(file_names)):
+            raw_names.append(os.path.join(temp_dir, f"{i}.raw"))
+            command += ["-map", f"{i}:a:0", "-acodec", "pcm_s16le", "-f", "s16le"]
+            command.append(raw_names[-1])
+        _, log = run_ffmpeg(command)
+
+        decoded = []
+        for raw_name, (frame_rate, channels) in zip(
+            raw_names, parse_output_formats(log)
+        ):
+            frames = np.fromfile(raw_name, dtype=np.int16).reshape(-1, channels)
+            decoded.append((frames, frame_rate))
+        return decoded
+
+
+def decode(file_name):
+    """ Decodes an audio file into 16-bit frames.
+
+    :type file_name: string
+    :param file_name: Path of the audio file
+
+    :raises: RuntimeError if the file can't be decoded
+
+    :rtype: tuple
+    """
+    if in_process(file_name):
+        return decode_in_process(file_name)
+    return decode_with_ffmpeg(file_name)
+
+
+def decode_many(file_names, num_workers=None):
+    """ Decodes many audio files into 16-bit frames. Files are
+    decoded in-process where possible, and otherwise in batches of
+    `batch_size` per ffmpeg process, with batches run in parallel.
+
+    :type file_names: list
+    :param file_names: Paths of the audio files
+
+    :type num_workers: int
+    :param num_workers: Number of threads (default: ThreadPoolExecutor's)
+
+    :raises: RuntimeError if a file can't be decoded
+
+    :rtype: list
+    """
+    file_names = list(file_names)
+    decoded = [None] * len(file_names)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        native = [i for i, file_name in enumerate(file_names) if in_process(file_name)]
+        for i, result in zip(
+            native, executor.map(decode_in_process, [file_names[i] for i in native])
+        ):
+            decoded[i] = result
+
+        rest = [i for i in range(len(file_names)) if decoded[i] is None]
+        batches = [rest[i : i + batch_size] for i in range(0, len(rest), batch_size)]
+        for batch, results in zip(
+            batches,
+            executor.map(
+                decode_batch_with_ffmpeg,
+                [[file_names[i] for i in batch] for batch in batches],
+            ),
+        ):
+            for i, result in zip(batch, results):
+                decoded[i] = result
+    return decoded
+
+
+def to_segment(frames, frame_rate):
+    """ Wraps decoded frames in an AudioSegment.
+
+    :type frames: numpy.ndarray
+    :param frames: Array of shape (num_frames, channels)
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :raises: N/A
+
+    :rtype: pydub.AudioSegment
+    """
+    return AudioSegment(
+        data=np.ascontiguousarray(frames).tobytes(),
+        sample_width=frames.dtype.itemsize,
+        frame_rate=frame_rate,
+        channels=frames.shape[1],
+    )
+
+
+def load_segment(file_name):
+    """ Drop-in replacement for AudioSegment.from_mp3 (or from_file).
+
+    :type file_name: string
+    :param file_name: Path of the audio file
+
+    :raises: RuntimeError if the file can't be decoded
+
+    :rtype: pydub.AudioSegment
+    """
+    return to_segment(*decode(file_name))
@@ -0,0 +1,319 @@
+# Non-blocking audio playback.
+#
+# pydub.playback.play blocks until the song ends, and goes through a
+# temporary WAV file and an external player on every call, so the
+# window can't update during a trial and the onset latency is
+# unknown. StreamPlayer keeps one output stream open and feeds it
+# PCM from a callback thread, so play() returns at once, and the
+# callback reports when the first frame reaches the audio device.
+
+import logging
+import threading
+import time
+import numpy as np
+from pydub.playback import play as blocking_play
+
+try:
+    import sounddevice
+except ImportError:
+    # Falls back to ThreadPlayer
+    sounddevice = None
+
+
+def segment_frames(song, frame_rate, channels):
+    """ 16-bit frames of a song in the given format, converting the
+    song only if it isn't in that format already.
+
+    :type song: pydub.AudioSegment
+    :param song: Song to play
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate of the output stream
+
+    :type channels: int
+    :param channels: Channels of the output stream
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    if song.frame_rate != frame_rate:
+        song = song.set_frame_rate(frame_rate)
+    if song.channels != channels:
+        song = song.set_channels(channels)
+    if song.sample_width != 2:
+        song = song.set_sample_width(2)
+    return np.frombuffer(song.raw_data, dtype=np.int16).reshape(-1, channels)
+
+
+class StreamPlayer:
+    """ Plays songs through a single, always-open output stream.
+    Timestamps (onset, end) come from `clock`.
+    """
+
+    def __init__(
+        self, frame_rate=44100, channels=2, latency="low", clock=time.perf_counter
+    ):
+        """
+        :type frame_rate: int
+        :param frame_rate: Frame rate of the output stream
+
+        :type channels: int
+        :param channels: Channels of the output stream
+
+        :type latency: string or float
+        :param latency: Suggested output latency ("low", "high" or seconds)
+
+        :type clock: function
+        :param clock: Returns the current time in seconds (e.g., core.getTime)
+
+        :raises: sounddevice.PortAudioError if the stream can't be opened
+        """
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.finished.set()
+        self.frames = None
+        self.position = 0
+        self.request_time = None
+        self.onset = None
+        self.end = None
+        self.underflows = 0
+        self.stream = sounddevice.OutputStream(
+            samplerate=frame_rate,
+            channels=channels,
+            dtype="int16",
+            latency=latency,
+            callback=self.callback,
+        )
+        self.stream.start()
+
+    def output_latency(self, time_info):
+        """ Seconds until the current buffer reaches the device.
+
+        :type time_info: CData
+        :param time_info: Time info passed to the stream callback
+
+        :raises: N/A
+
+        :rtype: float
+        """
+        latency = time_info.outputBufferDacTime - time_info.currentTime
+        if latency <= 0:
+            # Some host APIs don't report buffer times
+            latency = self.stream.latency
+        return latency
+
+    def callback(self, outdata, num_frames, time_info, status):
+        """ Stream callback: copies the next block of the current song,
+        padding with silence.
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        if status.output_underflow:
+            self.underflows += 1
+        with self.lock:
+            if self.frames is None:
+                outdata.fill(0)
+                return
+            start = self.position
+            stop = min(start + num_frames, len(self.frames))
+            outdata[: stop - start] = self.frames[start:stop]
+            outdata[stop - start :] = 0
+            self.position = stop
+
+            if start == 0:
+                self.onset = self.clock() + self.output_latency(time_info)
+            if stop == len(self.frames):
+                self.end = (
+                    self.clock()
+                    + self.output_latency(time_info)
+                    + (stop - start) / self.frame_rate
+                )
+                self.frames = None
+                self.finished.set()
+
+    def play(self, song):
+        """ Starts playing a song and returns immediately. Replaces
+        whatever is playing.
+
+        :type song: pydub.AudioSegment
+        :param song: Song to play
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        frames = segment_frames(song, self.frame_rate, self.channels)
+        with self.lock:
+            self.frames = frames
+            self.position = 0
+            self.request_time = self.clock()
+            self.onset = None
+            self.end = None
+            self.finished.clear()
+
+    def is_playing(self):
+        """ Whether a song is still playing.
+
+        :raises: N/A
+
+        :rtype: bool
+        """
+        return not self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """ Blocks until the song ends.
+
+        :type timeout: float
+        :param timeout: Seconds to wait at most (default: no limit)
+
+        :raises: N/A
+
+        :rtype: bool
+        """
+        return self.finished.wait(timeout)
+
+    def stop(self):
+        """ Stops the current song.
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        with self.lock:
+            self.frames = None
+            self.finished.set()
+
+    def close(self):
+        """ Stops playing and closes the stream.
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        self.stop()
+        self.stream.close()
+
+
+class ThreadPlayer:
+    """ Fallback for when sounddevice isn't installed: runs
+    pydub.playback.play on a thread. The onset is only when the
+    thread started, not when the device started playing.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        """
+        :type clock: function
+        :param clock: Returns the current time in seconds (e.g., core.getTime)
+
+        :raises: N/A
+        """
+        self.clock = clock
+        self.finished = threading.Event()
+        self.finished.set()
+        self.request_time = None
+        self.onset = None
+        self.end = None
+        self.underflows = 0
+
+    def play_in_thread(self, song):
+        """ Plays a song to the end, recording its onset and end.
+
+        :type song: pydub.AudioSegment
+        :param song: Song to play
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        self.onset = self.clock()
+        try:
+            blocking_play(song)
+        except Exception:
+            logging.exception("Couldn't play song")
+        self.end = self.clock()
+        self.finished.set()
+
+    def play(self, song):
+        """ Starts playing a song and returns immediately.
+
+        :type song: pydub.AudioSegment
+        :param song: Song to play
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        self.wait()
+        self.request_time = self.clock()
+        self.onset = None
+        self.end = None
+        self.finished.clear()
+        threading.Thread(target=self.play_in_thread, args=(song,), daemon=True).start()
+
+    def is_playing(self):
+        """ Whether a song is still playing.
+
+        :raises: N/A
+
+        :rtype: bool
+        """
+        return not self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """ Blocks until the song ends.
+
+        :type timeout: float
+        :param timeout: Seconds to wait at most (default: no limit)
+
+        :raises: N/A
+
+        :rtype: bool
+        """
+        return self.finished.wait(timeout)
+
+    def stop(self):
+        """ Does nothing: pydub's players can't be interrupted, and the
+        thread ends with the song (or the process).
+
+        :raises: N/A
+
+        :rtype: void
+        """
+
+    def close(self):
+        """ Waits for the current song to end.
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        self.wait()
+
+
+def make_player(frame_rate=44100, channels=2, clock=time.perf_counter):
+    """ A StreamPlayer if sounddevice is installed, otherwise a
+    ThreadPlayer.
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate of the output stream
+
+    :type channels: int
+    :param channels: Channels of the output stream
+
+    :type clock: function
+    :param clock: Returns the current time in seconds (e.g., core.getTime)
+
+    :raises: N/A
+
+    :rtype: StreamPlayer or ThreadPlayer
+    """
+    if sounddevice is None:
+        logging.warning("sounddevice isn't installed; onset times will be approximate")
+        return ThreadPlayer(clock=clock)
+    return StreamPlayer(frame_rate=frame_rate, channels=channels, clock=clock)
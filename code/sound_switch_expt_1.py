@@ -16,13 +16,13 @@ checked = False
 
 from psychopy import visual, monitors, core, event, os, data, gui, misc, logging
 from pydub import AudioSegment
-from pydub.playback import play
 import json
 import logging
 import numpy as np
 import os
 import random
 import socket
+import sys
 from stefan_utils import tabify
 from stefan_utils import rgb2psychorgb
 from stefan_utils import quit_experiment
@@ -30,7 +30,18 @@ from stefan_utils import get_subject_info
 from stefan_utils import make_data_file
 from stefan_utils import make_subject_file
 from stefan_utils import write_to_file
+from stefan_utils import TrialWriter
+from stefan_utils import make_journal_file
+from stefan_utils import make_history_file
 from stefan_utils import show_instructions
+from audio_decoding import decode_many, to_segment
+from audio_playback import make_player
+from stimulus_bank import StimulusBank
+from stimulus_loader import StimulusLoader
+
+stimuli_code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "stimuli")
+sys.path.append(stimuli_code_dir)
+from stimulus_export import load_song, manifest_song_name, read_manifest
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -100,6 +111,7 @@ def get_trial_data():
     trial_data["Block Duration"] = block_clock.getTime()
     trial_data["Session Duration"] = session_clock.getTime()
     trial_data["Experiment Duration"] = experiment_clock.getTime()
+    trial_data.update(playback_info)
     return trial_data
 
 
@@ -119,16 +131,38 @@ def do_trial(this_song_info, practiceOn):
 	:rtype:
 	"""
     global rating_scale
+    global playback_info
 
     trial_clock.reset()
     rating_scale = create_rating_scale()
 
-    this_song = this_song_info["song"]
+    this_song = stimulus_loader.get(this_song_info["song_name"])
     instructions.text = "Playing sequence..."
     for frame in range(num_blank_frames):
         instructions.draw()
         win.flip()
-    play(this_song)
+
+    # Playback runs on the audio callback thread; keep the window
+    # updating until the song ends, counting dropped frames
+    win.setRecordFrameIntervals(True)
+    num_dropped_frames = win.nDroppedFrames
+    player.play(this_song)
+    while player.is_playing():
+        instructions.draw()
+        win.flip()
+        if event.getKeys(key_dict["quit"]):
+            player.stop()
+            quit_experiment(win, core)
+    win.setRecordFrameIntervals(False)
+
+    # Times are on the trial clock
+    playback_info = {
+        "Scheduled Onset": player.request_time,
+        "Actual Onset": player.onset,
+        "Playback Duration": player.end - player.onset,
+        "Dropped Frames": win.nDroppedFrames - num_dropped_frames,
+    }
+    logging.debug(playback_info)
 
     # show & update until a response has been made
     while rating_scale.noResponse:
@@ -142,7 +176,9 @@ def do_trial(this_song_info, practiceOn):
     if not practiceOn:
         # Record response
         trial_data = get_trial_data()
-        write_to_file(data_file, trial_data, info_order)
+        write_to_file(
+            data_file, trial_data, info_order, sync=False, history_file=history_file
+        )
         logging.debug(trial_data)
 
         logging.debug(f"rating_scale.getRating() => {rating_scale.getRating()}")
@@ -170,12 +206,61 @@ def generate_trials():
     return trial_order
 
 
+def load_stimulus(song_name):
+    """ Reads a stimulus in the format its manifest
+	entry records.
+
+	:type song_name: string
+	:param song_name: Path of the stimulus
+
+	:raises: RuntimeError if the file can't be decoded
+
+	:rtype: pydub.AudioSegment
+	"""
+    return load_song(song_name, stimulus_manifest.get(os.path.basename(song_name)))
+
+
+def load_stimuli(song_names):
+    """ Reads several stimuli at once. MP3 and FLAC
+	stimuli are decoded together (one ffmpeg process
+	per batch, see audio_decoding.decode_many), and
+	the rest are read with load_stimulus.
+
+	:type song_names: list
+	:param song_names: Paths of the stimuli
+
+	:raises: RuntimeError if a file can't be decoded
+
+	:rtype: list
+	"""
+    compressed = [
+        song_name
+        for song_name in song_names
+        if os.path.splitext(song_name)[1] in (".mp3", ".flac")
+    ]
+    songs = {
+        song_name: to_segment(*decoded)
+        for song_name, decoded in zip(compressed, decode_many(compressed))
+    }
+    return [
+        songs[song_name] if song_name in songs else load_stimulus(song_name)
+        for song_name in song_names
+    ]
+
+
 ################################
 # * CONSTANTS
 ################################
 num_blank_frames = 30  # how many frames to wait before playing the sequence
+num_prefetch = 3  # how many upcoming songs to keep decoded
+decode_batch_size = 8  # how many songs to decode at once when prefetching
+trials_per_commit = 10  # how many trials to hold before syncing the data file
 data_dir = "../data/"
+data_format = "text"  # or "journal"; convert with python stefan_utils.py *.trials
 stimulus_dir = "../stimuli/combined/"
+stimulus_bank_name = f"{stimulus_dir}stimulus_bank.bin"  # see stimulus_bank.py
+playback_frame_rate = 44100  # output stream format if there's no stimulus bank
+playback_channels = 2
 switch_probabilities = np.linspace(0.1, 0.9, num=9)
 num_exemplars = 20
 chunk_size = 500
@@ -242,6 +327,10 @@ info_order = [
     "Block Duration",
     "Session Duration",
     "Experiment Duration",
+    "Scheduled Onset",
+    "Actual Onset",
+    "Playback Duration",
+    "Dropped Frames",
     "Start Date",
     "Experiment",
     "Testing Location",
@@ -272,7 +361,16 @@ exp_info["Condition"] = condition  # save to exp_info
 question_label = question_labels[condition]
 
 # Make data files
-data_file = make_data_file(data_dir, exp_info, info_order)
+# Trials are journaled as they come and synced in batches
+if data_format == "journal":
+    data_file = make_journal_file(data_dir, exp_info, info_order)
+else:
+    data_file = TrialWriter(
+        make_data_file(data_dir, exp_info, info_order), batch_size=trials_per_commit
+    )
+history_file = TrialWriter(
+    make_history_file(data_file.name), batch_size=trials_per_commit
+)
 subject_file = make_subject_file(data_dir, exp_info, sub_info_order)
 
 ################################
@@ -282,6 +380,7 @@ screen_width = 1280
 screen_height = 720
 units = "pix"
 resolution = [screen_width, screen_height]  # XXX: change for final computer
+refresh_rate = 60  # Hz; XXX: change for final computer
 
 win = visual.Window(
     fullscr=False,
@@ -292,6 +391,8 @@ win = visual.Window(
     monitor="testMonitor",
     winType="pyglet",
 )
+# Flips longer than a refresh (plus some slack) count as dropped frames
+win.refreshThreshold = 1.0 / refresh_rate + 0.004
 
 # Set up question text
 question = visual.TextStim(
@@ -305,24 +406,63 @@ question = visual.TextStim(
 ################################
 # * STIMULI
 ################################
-# Get sound stimuli
+# The manifest says which format each song was written in
+# (songs missing from it are MP3s)
+stimulus_manifest = read_manifest(stimulus_dir)
+
+# Get sound stimuli, from the packed stimulus bank if there is one.
+# Songs from the bank are read from a single mmapped file.
+if os.path.exists(stimulus_bank_name):
+    stimulus_bank = StimulusBank(stimulus_bank_name)
+    load_stimulus_song = stimulus_bank.segment
+    load_stimulus_songs = None
+else:
+    stimulus_bank = None
+    load_stimulus_song = load_stimulus
+    load_stimulus_songs = load_stimuli
+
 stimuli = {}
 for switch_probability in switch_probabilities:
     sp = str(round(switch_probability, 2))
-    stimuli[sp] = {"song_names": [], "songs": []}
+    stimuli[sp] = {"song_names": []}
     for exemplar in range(num_exemplars):
-        song_name = f"{stimulus_dir}switch-{sp}_chunk-{str(chunk_size)}_C_G_alternating_{str(exemplar).zfill(2)}.mp3"
+        song_stem = f"switch-{sp}_chunk-{str(chunk_size)}_C_G_alternating_{str(exemplar).zfill(2)}"
+        song_name = manifest_song_name(stimulus_dir, song_stem, stimulus_manifest)
         stimuli[sp]["song_names"].append(song_name)
-        this_song = AudioSegment.from_mp3(song_name)
-        stimuli[sp]["songs"].append(this_song)
 
 # Generate trial order
 trial_order = generate_trials()
 
 # Get practice stimulus
 this_song_info = {"switch_rate": "0.5", "exemplar": 0}
-this_song_info["song_name"] = f"{stimulus_dir}practice_pure_tones.mp3"
-this_song_info["song"] = AudioSegment.from_mp3(this_song_info["song_name"])
+this_song_info["song_name"] = manifest_song_name(
+    stimulus_dir, "practice_pure_tones", stimulus_manifest
+)
+
+# Decode songs on demand, in the order they will be played,
+# keeping the next few ready on a background thread. Files are
+# decoded a batch at a time rather than one ffmpeg process each.
+song_order = [this_song_info["song_name"]]
+for (switch_rate, exemplar) in trial_order + repeated_trial_order:
+    song_order.append(stimuli[switch_rate]["song_names"][exemplar])
+stimulus_loader = StimulusLoader(
+    load_stimulus_song,
+    song_order,
+    num_prefetch=num_prefetch,
+    load_many=load_stimulus_songs,
+    batch_size=decode_batch_size,
+)
+
+# Keep one output stream open in the stimuli's format for the
+# whole session. Playback times are on the trial clock.
+if stimulus_bank is not None:
+    player = make_player(
+        stimulus_bank.frame_rate, stimulus_bank.channels, clock=trial_clock.getTime
+    )
+else:
+    player = make_player(
+        playback_frame_rate, playback_channels, clock=trial_clock.getTime
+    )
 
 ################################
 # * INSTRUCTIONS
@@ -423,11 +563,12 @@ for (switch_rate, exemplar) in trial_order:
     this_song_info = {
         "switch_rate": switch_rate,
         "exemplar": exemplar,
-        "song": stimuli[switch_rate]["songs"][exemplar],
         "song_name": stimuli[switch_rate]["song_names"][exemplar],
     }
     logging.debug(f"Song info: {this_song_info}")
     do_trial(this_song_info, practiceOn=False)
+data_file.commit()
+history_file.commit()
 
 ################################
 # * TEST-RETEST SECTION
@@ -448,11 +589,12 @@ for (switch_rate, exemplar) in repeated_trial_order:
     this_song_info = {
         "switch_rate": switch_rate,
         "exemplar": exemplar,
-        "song": stimuli[switch_rate]["songs"][exemplar],
         "song_name": stimuli[switch_rate]["song_names"][exemplar],
     }
     logging.debug(f"Song info: {this_song_info}")
     do_trial(this_song_info, practiceOn=False)
+data_file.close()
+history_file.close()
 
 
 ################################
@@ -463,5 +605,10 @@ instructions_list = ["You're done! Please go to your experimenter."]
 
 show_instructions(instructions, instructions_list, key_dict, win)
 
+player.close()
+# Stop prefetching before unmapping the bank it reads from
+stimulus_loader.close()
+if stimulus_bank is not None:
+    stimulus_bank.close()
 quit_experiment(win, core)
 
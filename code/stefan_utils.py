@@ -2,8 +2,15 @@
 # Author: Stefan Uddenberg
 
 from psychopy import core, data, event, gui
+from collections import deque
+import atexit
+import glob
 import json
+import math
 import os
+import struct
+import sys
+import zlib
 
 def tabify(s):
 	""" Takes an array of strings and
@@ -132,6 +139,10 @@ def make_data_file(data_dir, exp_info, info_order, sync=True):
 		ext = '-' + str(i)
 		i += 1
 
+	# Replay journals left by a session that crashed (see TrialWriter)
+	for journal_name in glob.glob(f"{data_dir}*{journal_ext}"):
+		recover_data_file(journal_name[:-len(journal_ext)])
+
 	file_name = f"{data_dir}{file_name}{ext}"
 	data_file = open(f"{file_name}.txt", 'a')
 	line = tabify(info_order) + '\n'
@@ -179,7 +190,59 @@ def make_subject_file(data_dir, exp_info, sub_info_order, sync=True):
 
 	return sub_file
 
-def write_to_file(file_handle, info, info_order, sync=True):
+history_order = ['Subject ID', 'Trial #', 'Step', 'Value', 'Time']
+# Not .txt, so that globs for data files (e.g. 'Sound Switch*.txt') skip it
+history_ext = '.history.tsv'
+
+
+def make_history_file(data_file_name, sync=True):
+	""" Creates the companion file of a data file that holds each
+	trial's rating history as rows of history_order, named
+	<data file name without .txt>.history.tsv (see read_histories
+	in paper/session_data.py)
+	:type data_file_name: string
+	:param data_file_name: Path of the data file
+
+	:type sync: bool
+	:param sync: Whether to sync the header to disk
+
+	:raises: N/A
+
+	:rtype: file handle
+	"""
+
+	file_name = f"{os.path.splitext(data_file_name)[0]}{history_ext}"
+	history_file = open(file_name, 'a')
+	history_file.write(tabify(history_order) + '\n')
+	if sync:
+		history_file.flush()
+		os.fsync(history_file)
+
+	return history_file
+
+
+def history_lines(info, history_variable='Rating History'):
+	""" Rows of history_order for a trial's rating history.
+	Missing ratings are written as NaN.
+	:type info: dict
+	:param info: Trial data
+
+	:type history_variable: string
+	:param history_variable: Variable holding the (rating, time) pairs
+
+	:raises: N/A
+
+	:rtype: string
+	"""
+
+	lines = []
+	for step, (value, time) in enumerate(info[history_variable]):
+		value = 'NaN' if value is None else str(value)
+		lines.append(tabify([str(info['Subject ID']), str(info['Trial #']), str(step), value, str(time)]) + '\n')
+	return ''.join(lines)
+
+
+def write_to_file(file_handle, info, info_order, sync=True, history_file=None):
 	""" Writes a trial (a dictionary) to a fileHandle
 	:type file_handle:
 	:param file_handle:
@@ -193,16 +256,454 @@ def write_to_file(file_handle, info, info_order, sync=True):
 	:type sync:
 	:param sync:
 
+	:type history_file: file handle
+	:param history_file: If given, the rating history is also written
+		there, one row per step (see make_history_file)
+
 	:raises:
 
 	:rtype: void
 	"""
 
-	line = tabify([str(info[variable]) for variable in info_order]) + '\n'
-	file_handle.write(line)
+	if isinstance(file_handle, TrialJournal):
+		file_handle.write_trial(info)
+	else:
+		line = tabify([str(info[variable]) for variable in info_order]) + '\n'
+		file_handle.write(line)
+	if history_file is not None:
+		# One write per trial, so a TrialWriter holds whole trials
+		history_file.write(history_lines(info))
 	if sync:
 		file_handle.flush()
 		os.fsync(file_handle)
+		if history_file is not None:
+			history_file.flush()
+			os.fsync(history_file)
+
+journal_ext = '.journal'
+
+
+class TrialWriter:
+	""" File-like wrapper around a data file that commits trials in
+	groups instead of syncing after every one. Each trial is appended
+	to a journal next to the data file (flushed, but not synced) and
+	to an in-memory ring; every `batch_size` trials, at block
+	boundaries (commit()) and at exit, the ring is written to the data
+	file and synced, and the journal is cleared. If the experiment
+	crashes, recover_data_file() moves what is left in the journal
+	into the data file, so at most the trial being written is lost.
+
+	Use with write_to_file(..., sync=False); lines are written exactly
+	as they would have been to the data file.
+	"""
+
+	def __init__(self, file_handle, batch_size=10):
+		"""
+		:type file_handle: file handle
+		:param file_handle: Data file, e.g., from make_data_file
+
+		:type batch_size: int
+		:param batch_size: Trials held before committing them
+
+		:raises: N/A
+		"""
+
+		self.file_handle = file_handle
+		self.name = file_handle.name
+		self.batch_size = batch_size
+		self.ring = deque()
+		self.journal = open(f"{self.name}{journal_ext}", 'w')
+		self.closed = False
+		atexit.register(self.close)
+
+	def write(self, line):
+		""" Journals a trial's line and holds it for the next commit
+		:type line: string
+		:param line: Line to write, including its newline
+
+		:raises: N/A
+
+		:rtype: void
+		"""
+
+		self.journal.write(line)
+		self.journal.flush()
+		self.ring.append(line)
+		if len(self.ring) >= self.batch_size:
+			self.commit()
+
+	def commit(self):
+		""" Writes held trials to the data file, syncs it,
+		and clears the journal
+		:raises: N/A
+
+		:rtype: void
+		"""
+
+		if not self.ring:
+			return
+		self.file_handle.write(''.join(self.ring))
+		self.file_handle.flush()
+		os.fsync(self.file_handle)
+		self.ring.clear()
+		self.journal.seek(0)
+		self.journal.truncate()
+		self.journal.flush()
+
+	def flush(self):
+		""" Same as commit(), so that write_to_file(..., sync=True) still syncs
+		:raises: N/A
+
+		:rtype: void
+		"""
+
+		self.commit()
+
+	def fileno(self):
+		""" File descriptor of the data file
+		:raises: N/A
+
+		:rtype: int
+		"""
+
+		return self.file_handle.fileno()
+
+	def close(self):
+		""" Commits held trials, closes both files and
+		removes the journal
+		:raises: N/A
+
+		:rtype: void
+		"""
+
+		if self.closed:
+			return
+		self.commit()
+		self.journal.close()
+		os.remove(self.journal.name)
+		self.file_handle.close()
+		self.closed = True
+
+
+def recover_data_file(file_name):
+	""" Appends trials left in a data file's journal (after a crash)
+	to the data file. Trials a commit already wrote, entirely or in
+	part, aren't written twice.
+	:type file_name: string
+	:param file_name: Path of the data file
+
+	:raises: N/A
+
+	:rtype: int
+	"""
+
+	journal_name = f"{file_name}{journal_ext}"
+	if not os.path.exists(journal_name):
+		return 0
+	with open(journal_name, 'r') as journal:
+		pending = journal.read()
+	# Drop a trial that was only partly journaled
+	pending = pending[:pending.rfind('\n') + 1]
+	written = ''
+	if os.path.exists(file_name):
+		with open(file_name, 'r') as data_file:
+			written = data_file.read()
+
+	# A commit that was cut short wrote a prefix of the journal
+	overlap = min(len(written), len(pending))
+	while overlap > 0 and not written.endswith(pending[:overlap]):
+		overlap -= 1
+	with open(file_name, 'a') as data_file:
+		data_file.write(pending[overlap:])
+		data_file.flush()
+		os.fsync(data_file)
+	os.remove(journal_name)
+	return pending[overlap:].count('\n')
+
+
+trial_journal_ext = '.trials'
+trial_journal_magic = b'SSTRIAL1'
+record_header = '<II'  # payload length, CRC-32 of the payload
+
+
+def encode_value(value):
+	""" Encodes a value as a type tag and its bytes. Floats are
+	float64 and ints int64; a rating history (a list of (rating, time)
+	pairs) is an array of float64 pairs, with None ratings as NaN.
+	Anything else is stored as its str().
+	:type value: anything
+	:param value: Value to encode
+
+	:raises: N/A
+
+	:rtype: bytes
+	"""
+
+	if value is None:
+		return b'N'
+	elif type(value) is bool:
+		return b'?' + struct.pack('<?', value)
+	elif type(value) is int and -2**63 <= value < 2**63:
+		return b'q' + struct.pack('<q', value)
+	elif type(value) is float:
+		return b'd' + struct.pack('<d', value)
+	elif type(value) is list and all(
+		type(pair) is tuple and len(pair) == 2 and type(pair[1]) is float
+		for pair in value
+	):
+		ratings = [pair[0] for pair in value]
+		if all(rating is None or type(rating) is int for rating in ratings):
+			tag = b'h'  # integer ratings
+		elif all(rating is None or type(rating) is float for rating in ratings):
+			tag = b'H'  # float ratings
+		else:
+			tag = None
+		if tag is not None:
+			numbers = []
+			for rating, time in value:
+				numbers.extend([math.nan if rating is None else rating, time])
+			return tag + struct.pack(f'<I{len(numbers)}d', len(value), *numbers)
+	encoded = str(value).encode('utf-8')
+	return b's' + struct.pack('<I', len(encoded)) + encoded
+
+
+def decode_value(payload, offset):
+	""" Decodes a value written by encode_value
+	:type payload: bytes
+	:param payload: Encoded record
+
+	:type offset: int
+	:param offset: Where the value starts
+
+	:raises: ValueError if the type tag is unknown
+
+	:rtype: tuple
+	"""
+
+	tag = payload[offset:offset + 1]
+	offset += 1
+	if tag == b'N':
+		return None, offset
+	elif tag == b'?':
+		return struct.unpack_from('<?', payload, offset)[0], offset + 1
+	elif tag == b'q':
+		return struct.unpack_from('<q', payload, offset)[0], offset + 8
+	elif tag == b'd':
+		return struct.unpack_from('<d', payload, offset)[0], offset + 8
+	elif tag in (b'h', b'H'):
+		num_pairs = struct.unpack_from('<I', payload, offset)[0]
+		numbers = struct.unpack_from(f'<{2 * num_pairs}d', payload, offset + 4)
+		history = []
+		for rating, time in zip(numbers[::2], numbers[1::2]):
+			if math.isnan(rating):
+				rating = None
+			elif tag == b'h':
+				rating = int(rating)
+			history.append((rating, time))
+		return history, offset + 4 + 16 * num_pairs
+	elif tag == b's':
+		length = struct.unpack_from('<I', payload, offset)[0]
+		start = offset + 4
+		return payload[start:start + length].decode('utf-8'), start + length
+	raise ValueError(f"Unknown type tag: {tag}")
+
+
+class TrialJournal:
+	""" Append-only binary alternative to the tab-separated data file.
+	After a header holding info_order, each trial is one record: its
+	length and CRC-32, then every variable in info_order as a typed
+	value (see encode_value). Use with write_to_file; read_journal,
+	recover_journal and journal_to_text read it back.
+	"""
+
+	def __init__(self, file_name, info_order):
+		"""
+		:type file_name: string
+		:param file_name: Path of the journal
+
+		:type info_order: list
+		:param info_order: Variables to record, in order
+
+		:raises: N/A
+		"""
+
+		self.name = file_name
+		self.info_order = info_order
+		self.file_handle = open(file_name, 'ab')
+		if self.file_handle.tell() == 0:
+			encoded_order = json.dumps(info_order).encode('utf-8')
+			self.file_handle.write(trial_journal_magic)
+			self.file_handle.write(struct.pack('<I', len(encoded_order)))
+			self.file_handle.write(encoded_order)
+
+	def write_trial(self, info):
+		""" Appends a trial and flushes it to the OS (see commit() to sync)
+		:type info: dict
+		:param info: Trial data, keyed by the variables in info_order
+
+		:raises: N/A
+
+		:rtype: void
+		"""
+
+		payload = b''.join(encode_value(info[variable]) for variable in self.info_order)
+		self.file_handle.write(struct.pack(record_header, len(payload), zlib.crc32(payload)))
+		self.file_handle.write(payload)
+		self.file_handle.flush()
+
+	def flush(self):
+		""" Flushes written trials to the OS
+		:raises: N/A
+
+		:rtype: void
+		"""
+
+		self.file_handle.flush()
+
+	def fileno(self):
+		""" File descriptor of the journal
+		:raises: N/A
+
+		:rtype: int
+		"""
+
+		return self.file_handle.fileno()
+
+	def commit(self):
+		""" Flushes and syncs written trials
+		:raises: N/A
+
+		:rtype: void
+		"""
+
+		self.file_handle.flush()
+		os.fsync(self.file_handle)
+
+	def close(self):
+		""" Syncs and closes the journal
+		:raises: N/A
+
+		:rtype: void
+		"""
+
+		if not self.file_handle.closed:
+			self.commit()
+			self.file_handle.close()
+
+
+def make_journal_file(data_dir, exp_info, info_order):
+	""" Creates a binary trial journal, named like make_data_file's
+	data file
+	:type data_dir: string
+	:param data_dir: Data directory
+
+	:type exp_info: dict
+	:param exp_info: Dictionary of experiment information
+
+	:type info_order: list
+	:param info_order: Variables to record, in order
+
+	:raises: N/A
+
+	:rtype: TrialJournal
+	"""
+
+	file_name = "_".join([exp_info['Experiment'], exp_info['Subject ID'], exp_info['Subject Initials'],
+						exp_info['Subject Age'], exp_info['Subject Gender'], exp_info['Start Date']])
+	ext = ''
+	i = 1
+	while os.path.exists(f"{data_dir}{file_name}{ext}{trial_journal_ext}"):
+		ext = '-' + str(i)
+		i += 1
+
+	journal = TrialJournal(f"{data_dir}{file_name}{ext}{trial_journal_ext}", info_order)
+	journal.commit()
+	return journal
+
+
+def read_journal(file_name):
+	""" Reads the trials in a binary trial journal, stopping at the
+	first incomplete or corrupt record. Returns info_order, the trials
+	(as dicts) and the offset just past the last complete trial.
+	:type file_name: string
+	:param file_name: Path of the journal
+
+	:raises: ValueError if the file isn't a trial journal
+
+	:rtype: tuple
+	"""
+
+	with open(file_name, 'rb') as journal:
+		contents = journal.read()
+	if contents[:len(trial_journal_magic)] != trial_journal_magic:
+		raise ValueError(f"{file_name} is not a trial journal")
+	offset = len(trial_journal_magic)
+	order_length = struct.unpack_from('<I', contents, offset)[0]
+	offset += 4
+	info_order = json.loads(contents[offset:offset + order_length].decode('utf-8'))
+	offset += order_length
+
+	trials = []
+	header_size = struct.calcsize(record_header)
+	while offset + header_size <= len(contents):
+		length, crc = struct.unpack_from(record_header, contents, offset)
+		payload = contents[offset + header_size:offset + header_size + length]
+		if len(payload) < length or zlib.crc32(payload) != crc:
+			break
+		trial = {}
+		position = 0
+		for variable in info_order:
+			trial[variable], position = decode_value(payload, position)
+		trials.append(trial)
+		offset += header_size + length
+	return info_order, trials, offset
+
+
+def recover_journal(file_name):
+	""" Replays a journal that was cut short (e.g., by a crash), and
+	truncates it after its last complete trial so that it can be
+	appended to again
+	:type file_name: string
+	:param file_name: Path of the journal
+
+	:raises: ValueError if the file isn't a trial journal
+
+	:rtype: int
+	"""
+
+	info_order, trials, end = read_journal(file_name)
+	if os.path.getsize(file_name) > end:
+		with open(file_name, 'r+b') as journal:
+			journal.truncate(end)
+			journal.flush()
+			os.fsync(journal)
+	return len(trials)
+
+
+def journal_to_text(file_name, text_file_name=None):
+	""" Converts a binary trial journal to the tab-separated layout
+	of make_data_file and write_to_file
+	:type file_name: string
+	:param file_name: Path of the journal
+
+	:type text_file_name: string
+	:param text_file_name: Path of the text file (default: the
+		journal's, ending in .txt)
+
+	:raises: ValueError if the file isn't a trial journal
+
+	:rtype: string
+	"""
+
+	if text_file_name is None:
+		text_file_name = f"{os.path.splitext(file_name)[0]}.txt"
+	info_order, trials, end = read_journal(file_name)
+	with open(text_file_name, 'w') as text_file:
+		text_file.write(tabify(info_order) + '\n')
+		for trial in trials:
+			text_file.write(tabify([str(trial[variable]) for variable in info_order]) + '\n')
+	return text_file_name
+
 
 def quit_experiment(win, core):
 	""" Quits an experiment
@@ -220,3 +721,17 @@ def quit_experiment(win, core):
 	win.close()
 	core.quit()
 
+
+if __name__ == '__main__':
+	# Usage: python stefan_utils.py data.txt.journal journal.trials [...]
+	# Replays each data file journal (left by TrialWriter) into its data
+	# file, and recovers each binary trial journal and writes it out as a
+	# .txt data file
+	for file_name in sys.argv[1:]:
+		if file_name.endswith(journal_ext):
+			data_file_name = file_name[:-len(journal_ext)]
+			num_trials = recover_data_file(data_file_name)
+			print(f"{file_name}: {num_trials} trials -> {data_file_name}")
+		else:
+			num_trials = recover_journal(file_name)
+			print(f"{file_name}: {num_trials} trials -> {journal_to_text(file_name)}")
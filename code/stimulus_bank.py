@@ -0,0 +1,233 @@
+# Packed, memory-mapped stimulus bank.
+#
+# Packs every stimulus into one file: a small header and index
+# (switch rate, exemplar, source type, offset, length) followed by
+# contiguous PCM. The experiment memory-maps the bank and reads each
+# trial's stimulus straight out of it (frames are zero-copy views),
+# instead of opening and decoding each MP3 separately. Source types
+# come from the stimulus directory's Notes.txt.
+#
+# Usage: python stimulus_bank.py [stimulus_dir] [bank_file_name]
+
+from audio_decoding import decode_many, to_segment
+from pydub import AudioSegment
+from stimulus_notes import notes_name, read_notes, stimulus_type
+import glob
+import json
+import mmap
+import numpy as np
+import os
+import struct
+import sys
+
+magic = b"SSBANK01"
+header_format = "<8sQ"  # magic, length of the JSON index in bytes
+alignment = 64  # PCM data starts on a 64-byte boundary
+sample_dtypes = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def parse_song_name(song_name):
+    """ Recovers the switch rate and exemplar from a file name like
+    switch-0.3_chunk-500_C_G_alternating_10.mp3.
+
+    :type song_name: string
+    :param song_name: Path or file name of the stimulus
+
+    :raises: N/A
+
+    :rtype: tuple
+    """
+    stem = os.path.splitext(os.path.basename(song_name))[0]
+    if not stem.startswith("switch-"):
+        return None, None
+    parts = stem.split("_")
+    return parts[0][len("switch-") :], int(parts[-1])
+
+
+def pack_stimulus_bank(song_names, bank_file_name, load=None, notes_file_name=None):
+    """ Decodes the given stimuli and packs them into a bank file.
+    All stimuli are converted to a common format first. Source types
+    come from the stimulus directory's Notes.txt.
+
+    :type song_names: list
+    :param song_names: Paths of the stimuli to pack
+
+    :type bank_file_name: string
+    :param bank_file_name: Path of the bank file to write
+
+    :type load: function
+    :param load: Decodes a path into an AudioSegment (default: decode
+        all stimuli in one batch with audio_decoding.decode_many)
+
+    :type notes_file_name: string
+    :param notes_file_name: Path of Notes.txt (default: the one next
+        to the first stimulus)
+
+    :raises: ValueError if an exemplar isn't in Notes.txt
+
+    :rtype: dict
+    """
+    if notes_file_name is None:
+        notes_file_name = os.path.join(os.path.dirname(song_names[0]), notes_name)
+    ranges = read_notes(notes_file_name)
+
+    if load is None:
+        songs = [to_segment(*decoded) for decoded in decode_many(song_names)]
+    else:
+        songs = [load(song_name) for song_name in song_names]
+    songs = AudioSegment._sync(*songs)
+    entries = []
+    offset = 0
+    for song_name, song in zip(song_names, songs):
+        switch_rate, exemplar = parse_song_name(song_name)
+        if exemplar is None:
+            kind = "tone"
+        else:
+            kind = stimulus_type(exemplar, ranges)
+        entries.append(
+            {
+                "song_name": os.path.basename(song_name),
+                "switch_rate": switch_rate,
+                "exemplar": exemplar,
+                "source_type": kind,
+                "offset": offset,
+                "length": int(song.frame_count()),
+            }
+        )
+        offset += len(song.raw_data)
+
+    index = {
+        "frame_rate": songs[0].frame_rate,
+        "channels": songs[0].channels,
+        "sample_width": songs[0].sample_width,
+        "entries": entries,
+    }
+    encoded_index = json.dumps(index).encode()
+    header_length = struct.calcsize(header_format) + len(encoded_index)
+    padding = -header_length % alignment
+
+    temp_file_name = f"{bank_file_name}.tmp"
+    with open(temp_file_name, "wb") as bank_file:
+        bank_file.write(struct.pack(header_format, magic, len(encoded_index)))
+        bank_file.write(encoded_index)
+        bank_file.write(b"\0" * padding)
+        for song in songs:
+            bank_file.write(song.raw_data)
+    os.replace(temp_file_name, bank_file_name)
+    return index
+
+
+class StimulusBank:
+    """ Read-only, memory-mapped view of a packed stimulus bank.
+    Keep the bank open for as long as its songs are in use.
+    """
+
+    def __init__(self, bank_file_name):
+        """
+        :type bank_file_name: string
+        :param bank_file_name: Path of the bank file
+
+        :raises: ValueError if the file isn't a stimulus bank
+        """
+        self.bank_file = open(bank_file_name, "rb")
+        self.buffer = mmap.mmap(self.bank_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header_size = struct.calcsize(header_format)
+        file_magic, index_length = struct.unpack(
+            header_format, self.buffer[:header_size]
+        )
+        if file_magic != magic:
+            raise ValueError(f"{bank_file_name} is not a stimulus bank")
+        index = json.loads(self.buffer[header_size : header_size + index_length])
+        header_length = header_size + index_length
+        self.data_offset = header_length + (-header_length % alignment)
+
+        self.frame_rate = index["frame_rate"]
+        self.channels = index["channels"]
+        self.sample_width = index["sample_width"]
+        self.dtype = sample_dtypes[self.sample_width]
+        self.entries = {entry["song_name"]: entry for entry in index["entries"]}
+        self.cells = {
+            (entry["switch_rate"], entry["exemplar"]): entry
+            for entry in index["entries"]
+            if entry["switch_rate"] is not None
+        }
+
+    def entry(self, song_name):
+        """ Index entry of a stimulus.
+
+        :type song_name: string
+        :param song_name: Path or file name of the stimulus
+
+        :raises: KeyError if the stimulus isn't in the bank
+
+        :rtype: dict
+        """
+        return self.entries[os.path.basename(song_name)]
+
+    def raw_data(self, song_name):
+        """ Zero-copy view of a stimulus's PCM bytes.
+
+        :type song_name: string
+        :param song_name: Path or file name of the stimulus
+
+        :raises: KeyError if the stimulus isn't in the bank
+
+        :rtype: memoryview
+        """
+        entry = self.entry(song_name)
+        start = self.data_offset + entry["offset"]
+        num_bytes = entry["length"] * self.channels * self.sample_width
+        return memoryview(self.buffer)[start : start + num_bytes]
+
+    def frames(self, song_name):
+        """ Zero-copy array of a stimulus's frames.
+
+        :type song_name: string
+        :param song_name: Path or file name of the stimulus
+
+        :raises: KeyError if the stimulus isn't in the bank
+
+        :rtype: numpy.ndarray
+        """
+        samples = np.frombuffer(self.raw_data(song_name), dtype=self.dtype)
+        return samples.reshape(-1, self.channels)
+
+    def segment(self, song_name):
+        """ AudioSegment of a stimulus. Its PCM is copied out of the bank
+        so that slicing and concatenating work as for any other
+        AudioSegment; use frames for zero-copy access.
+
+        :type song_name: string
+        :param song_name: Path or file name of the stimulus
+
+        :raises: KeyError if the stimulus isn't in the bank
+
+        :rtype: pydub.AudioSegment
+        """
+        return AudioSegment(
+            data=bytes(self.raw_data(song_name)),
+            sample_width=self.sample_width,
+            frame_rate=self.frame_rate,
+            channels=self.channels,
+        )
+
+    def close(self):
+        """ Unmaps the bank. Views handed out must no longer be used.
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        self.buffer.close()
+        self.bank_file.close()
+
+
+if __name__ == "__main__":
+    stimulus_dir = sys.argv[1] if len(sys.argv) > 1 else "../stimuli/combined/"
+    bank_file_name = (
+        sys.argv[2] if len(sys.argv) > 2 else os.path.join(stimulus_dir, "stimulus_bank.bin")
+    )
+    song_names = sorted(glob.glob(os.path.join(stimulus_dir, "*.mp3")))
+    index = pack_stimulus_bank(song_names, bank_file_name)
+    print(f"Packed {len(index['entries'])} stimuli into {bank_file_name}")
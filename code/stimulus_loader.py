@@ -0,0 +1,224 @@
+# Lazy, prefetching stimulus loader.
+#
+# Instead of decoding every stimulus before the first instruction
+# screen, songs are decoded on demand along the known presentation
+# order. A background thread keeps the next few songs decoded in a
+# bounded LRU, so trials don't wait on decoding and only a handful
+# of songs are held in memory at once. Given a `load_many`, upcoming
+# songs are decoded a batch at a time (e.g., one ffmpeg process per
+# batch with audio_decoding.decode_many).
+
+from collections import OrderedDict
+import logging
+import threading
+
+
+class StimulusLoader:
+    """ Loads songs in presentation order, prefetching the next
+    `num_prefetch` songs on a background thread.
+    """
+
+    def __init__(
+        self,
+        load,
+        song_names,
+        num_prefetch=3,
+        capacity=None,
+        load_many=None,
+        batch_size=1,
+    ):
+        """
+        :type load: function
+        :param load: Decodes a song name into a song (e.g., AudioSegment.from_mp3)
+
+        :type song_names: list
+        :param song_names: Song names in the order they will be requested
+
+        :type num_prefetch: int
+        :param num_prefetch: How many upcoming songs to keep decoded
+
+        :type capacity: int
+        :param capacity: Maximum songs held at once (default:
+            num_prefetch + batch_size + 1)
+
+        :type load_many: function
+        :param load_many: Decodes a list of song names into a list of
+            songs (default: calls `load` on each)
+
+        :type batch_size: int
+        :param batch_size: How many songs to prefetch at once, once
+            fewer than `num_prefetch` upcoming songs are decoded
+
+        :raises: N/A
+        """
+        self.load = load
+        self.load_many = load_many
+        self.song_names = list(song_names)
+        self.num_prefetch = num_prefetch
+        self.batch_size = max(batch_size, 1)
+        self.capacity = max(
+            capacity or num_prefetch + self.batch_size + 1,
+            num_prefetch + self.batch_size,
+        )
+        self.songs = OrderedDict()
+        self.loading = set()
+        self.failed = set()
+        self.position = 0
+        self.hits = 0
+        self.misses = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.prefetch_loop, daemon=True)
+        self.thread.start()
+
+    def is_pending(self, song_name):
+        """ Whether a song still has to be prefetched. Call with the
+        condition held.
+
+        :type song_name: string
+        :param song_name: Name of the song
+
+        :raises: N/A
+
+        :rtype: bool
+        """
+        return (
+            song_name not in self.songs
+            and song_name not in self.loading
+            and song_name not in self.failed
+        )
+
+    def next_to_prefetch(self):
+        """ The next batch of upcoming songs that aren't decoded yet,
+        if any of the next `num_prefetch` songs is missing. Call with
+        the condition held.
+
+        :raises: N/A
+
+        :rtype: list
+        """
+        upcoming = self.song_names[self.position : self.position + self.num_prefetch]
+        if not any(self.is_pending(song_name) for song_name in upcoming):
+            return []
+        end = self.position + self.num_prefetch + self.batch_size - 1
+        batch = []
+        for song_name in self.song_names[self.position : end]:
+            if self.is_pending(song_name) and song_name not in batch:
+                batch.append(song_name)
+                if len(batch) == self.batch_size:
+                    break
+        return batch
+
+    def load_batch(self, song_names):
+        """ Decodes several songs, with `load_many` if there is one.
+
+        :type song_names: list
+        :param song_names: Names of the songs
+
+        :raises: Whatever `load` or `load_many` raises
+
+        :rtype: list
+        """
+        if self.load_many is None:
+            return [self.load(song_name) for song_name in song_names]
+        return list(self.load_many(song_names))
+
+    def store(self, song_name, song):
+        """ Adds a song to the LRU, evicting the least recently used
+        songs beyond capacity (songs that are still to come go last).
+        Call with the condition held.
+
+        :type song_name: string
+        :param song_name: Name of the song
+
+        :type song: pydub.AudioSegment
+        :param song: The decoded song
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        self.songs[song_name] = song
+        self.songs.move_to_end(song_name)
+        end = self.position + self.num_prefetch + self.batch_size
+        upcoming = set(self.song_names[self.position : end])
+        while len(self.songs) > self.capacity:
+            past = [name for name in self.songs if name not in upcoming]
+            del self.songs[past[0] if past else next(iter(self.songs))]
+
+    def prefetch_loop(self):
+        """ Background thread: decodes upcoming songs as the
+        presentation order advances.
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        while True:
+            with self.condition:
+                batch = self.next_to_prefetch()
+                while not self.closed and not batch:
+                    self.condition.wait()
+                    batch = self.next_to_prefetch()
+                if self.closed:
+                    return
+                self.loading.update(batch)
+
+            try:
+                songs = self.load_batch(batch)
+            except Exception:
+                # Leave it to get() to load them again and raise
+                logging.exception(f"Couldn't prefetch {batch}")
+                songs = None
+
+            with self.condition:
+                self.loading.difference_update(batch)
+                if songs is None:
+                    self.failed.update(batch)
+                else:
+                    for song_name, song in zip(batch, songs):
+                        self.store(song_name, song)
+                self.condition.notify_all()
+
+    def get(self, song_name):
+        """ Returns a song, decoding it now if it wasn't prefetched,
+        and moves the prefetch window past it.
+
+        :type song_name: string
+        :param song_name: Name of the song
+
+        :raises: Whatever `load` raises
+
+        :rtype: pydub.AudioSegment
+        """
+        with self.condition:
+            if song_name in self.song_names[self.position :]:
+                self.position = self.song_names.index(song_name, self.position) + 1
+            self.condition.notify_all()
+
+            while song_name in self.loading:
+                self.condition.wait()
+            if song_name in self.songs:
+                self.hits += 1
+                self.songs.move_to_end(song_name)
+                return self.songs[song_name]
+            self.misses += 1
+
+        song = self.load(song_name)
+        with self.condition:
+            self.failed.discard(song_name)
+            self.store(song_name, song)
+        return song
+
+    def close(self):
+        """ Stops the prefetch thread and drops all songs.
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        with self.condition:
+            self.closed = True
+            self.songs.clear()
+            self.condition.notify_all()
+        self.thread.join()
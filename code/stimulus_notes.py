@@ -0,0 +1,57 @@
+# Stimulus types from a stimulus directory's Notes.txt.
+#
+# Notes.txt says which exemplars are guitar chords and which are pure
+# tones (e.g., "00-09 are guitar tones, 10-19 are pure tones"). Both
+# the stimulus bank and paper/stimulus_catalog.py read it through
+# here, so neither hardcodes the exemplar ranges.
+
+import re
+
+notes_name = "Notes.txt"  # in each stimulus directory
+
+# Notes.txt lines such as "00-09 are guitar tones, 10-19 are pure tones"
+notes_pattern = r"(\d+)\s*-\s*(\d+) are (\w+)"
+
+# Stimulus type named by each word in Notes.txt
+stimulus_type_words = {"guitar": "guitar", "pure": "tone"}
+
+
+def read_notes(notes_file_name):
+    """ (first, last, stimulus type) exemplar ranges, from Notes.txt.
+
+    :type notes_file_name: string
+    :param notes_file_name: Path of Notes.txt
+
+    :raises: ValueError if the notes don't name any ranges
+
+    :rtype: list
+    """
+    with open(notes_file_name, "r") as fp:
+        notes = fp.read()
+    ranges = [
+        (int(low), int(high), stimulus_type_words[word.lower()])
+        for low, high, word in re.findall(notes_pattern, notes)
+        if word.lower() in stimulus_type_words
+    ]
+    if not ranges:
+        raise ValueError(f"No exemplar ranges in {notes_file_name}")
+    return ranges
+
+
+def stimulus_type(exemplar, ranges):
+    """ Stimulus type of an exemplar.
+
+    :type exemplar: int
+    :param exemplar: Exemplar index
+
+    :type ranges: list
+    :param ranges: Exemplar ranges, as returned by read_notes
+
+    :raises: ValueError if the exemplar isn't in any range
+
+    :rtype: string
+    """
+    for first, last, type_name in ranges:
+        if first <= exemplar <= last:
+            return type_name
+    raise ValueError(f"Exemplar not in Notes.txt: {exemplar}")
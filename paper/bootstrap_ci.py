@@ -0,0 +1,215 @@
+# Bootstrap confidence intervals for rating curves.
+#
+# sns.lineplot(ci=95) bootstraps every (condition, stimulus type,
+# switch rate) cell one at a time, each time a plot is drawn, and
+# resamples trials rather than subjects. Here each condition's
+# subjects x cells table of mean ratings is resampled as a whole:
+# a batch of resamples is a matrix of subject weights (how often each
+# subject was drawn), so the resampled means of every cell are one
+# matrix product. Batches are spread over a pool of worker processes,
+# seeded from a single seed so the intervals are the same for any
+# number of workers, and finished tables are cached by content.
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+
+# Resamples drawn by each task; fixed so that the seeds (and so the
+# intervals) don't depend on the number of workers
+resamples_per_task = 250
+
+# CI tables computed in this process, by key
+cache = {}
+
+
+def subject_means(data, group, x, hue, subject, dv):
+    """ Mean of the dependent variable per subject and cell, one row
+    per (group, subject) and one column per (hue, x) cell.
+
+    :type data: pandas.DataFrame
+    :param data: Trials
+
+    :type group: string
+    :param group: Between-subjects column (e.g., "Condition")
+
+    :type x: string
+    :param x: Column on the x axis (e.g., "Switch Rate")
+
+    :type hue: string
+    :param hue: Column of the separate curves (e.g., "Stimulus Type")
+
+    :type subject: string
+    :param subject: Subject ID column
+
+    :type dv: string
+    :param dv: Dependent variable (e.g., "Rating")
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    means = pd.DataFrame(data).groupby([group, subject, hue, x])[dv].mean()
+    return means.unstack([hue, x]).sort_index(axis=1)
+
+
+def resample_means(means, num_resamples, seed):
+    """ Cell means of bootstrap resamples of subjects. Subjects
+    missing a cell don't count towards that cell's mean.
+
+    :type means: numpy.ndarray
+    :param means: Subjects x cells means
+
+    :type num_resamples: int
+    :param num_resamples: Number of resamples
+
+    :type seed: numpy.random.SeedSequence
+    :param seed: Seed of this batch
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    num_subjects = means.shape[0]
+    filled = np.isfinite(means)
+    values = np.where(filled, means, 0.0)
+    # Drawing n subjects with replacement is the same as drawing how
+    # many times each subject is picked
+    weights = rng.multinomial(
+        num_subjects, np.full(num_subjects, 1.0 / num_subjects), size=num_resamples
+    ).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (weights @ values) / (weights @ filled)
+
+
+def table_key(means, num_resamples, ci, seed):
+    """ Cache key of a CI table: a hash of the subject means and the
+    bootstrap parameters.
+
+    :type means: pandas.DataFrame
+    :param means: Subject means, as returned by subject_means
+
+    :type num_resamples: int
+    :param num_resamples: Number of resamples
+
+    :type ci: float
+    :param ci: Size of the interval in percent
+
+    :type seed: int
+    :param seed: Seed of the resamples
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((list(means.index), list(means.columns))).encode())
+    digest.update(np.ascontiguousarray(means.values, dtype=np.float64).tobytes())
+    digest.update(repr((num_resamples, float(ci), seed)).encode())
+    return digest.hexdigest()
+
+
+def bootstrap_ci(
+    data,
+    group="Condition",
+    x="Switch Rate",
+    hue="Stimulus Type",
+    subject="Subject ID",
+    dv="Rating",
+    num_resamples=1000,
+    ci=95,
+    seed=0,
+    num_workers=None,
+    cache_dir=None,
+):
+    """ Mean and percentile bootstrap interval of every (group, hue, x)
+    cell, resampling subjects within each group.
+
+    :type data: pandas.DataFrame
+    :param data: Trials
+
+    :type group: string
+    :param group: Between-subjects column
+
+    :type x: string
+    :param x: Column on the x axis
+
+    :type hue: string
+    :param hue: Column of the separate curves
+
+    :type subject: string
+    :param subject: Subject ID column
+
+    :type dv: string
+    :param dv: Dependent variable
+
+    :type num_resamples: int
+    :param num_resamples: Number of resamples per group
+
+    :type ci: float
+    :param ci: Size of the interval in percent
+
+    :type seed: int
+    :param seed: Seed of the resamples
+
+    :type num_workers: int
+    :param num_workers: Number of worker processes (1: no pool)
+
+    :type cache_dir: string
+    :param cache_dir: Directory to also cache tables in across sessions
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    means = subject_means(data, group, x, hue, subject, dv)
+    key = table_key(means, num_resamples, ci, seed)
+    if key in cache:
+        return cache[key].copy()
+    cache_file_name = None
+    if cache_dir is not None:
+        cache_file_name = os.path.join(cache_dir, f"{key}.pkl")
+        if os.path.exists(cache_file_name):
+            cache[key] = pd.read_pickle(cache_file_name)
+            return cache[key].copy()
+
+    groups = list(means.index.get_level_values(0).unique())
+    group_means = [means.loc[g].dropna(how="all").values for g in groups]
+    sizes = [resamples_per_task] * (num_resamples // resamples_per_task)
+    if num_resamples % resamples_per_task:
+        sizes.append(num_resamples % resamples_per_task)
+    seeds = np.random.SeedSequence(seed).spawn(len(groups) * len(sizes))
+    tasks = [
+        (m, size, seeds[i * len(sizes) + j])
+        for i, m in enumerate(group_means)
+        for j, size in enumerate(sizes)
+    ]
+    if num_workers == 1:
+        batches = [resample_means(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            batches = list(executor.map(resample_means, *zip(*tasks)))
+
+    tail = (100 - ci) / 2
+    tables = []
+    for i, (g, m) in enumerate(zip(groups, group_means)):
+        resamples = np.concatenate(batches[i * len(sizes) : (i + 1) * len(sizes)])
+        low, high = np.nanpercentile(resamples, [tail, 100 - tail], axis=0)
+        table = means.columns.to_frame(index=False)
+        table.insert(0, group, g)
+        table["Mean"] = np.nanmean(m, axis=0)
+        table["CI Lower"] = low
+        table["CI Upper"] = high
+        table["Subjects"] = np.isfinite(m).sum(axis=0)
+        tables.append(table)
+    table = pd.concat(tables, ignore_index=True)
+
+    cache[key] = table
+    if cache_file_name is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_file_name = f"{cache_file_name}.tmp"
+        table.to_pickle(temp_file_name)
+        os.replace(temp_file_name, cache_file_name)
+    return table.copy()
@@ -0,0 +1,434 @@
+# Mixed-design ANOVA in NumPy/SciPy.
+#
+# An in-process version of the afex::aov_ez model in the paper: type
+# III sums of squares for between-subjects factors crossed with
+# within-subjects factors, with Greenhouse-Geisser corrections,
+# partial eta-squared, and emmeans-style polynomial contrasts. Like
+# aov_ez, trials are first averaged into one mean per subject and
+# within-subjects cell.
+#
+# Each within-subjects effect is tested by transforming every
+# subject's cell means with orthonormal contrasts for that effect and
+# fitting a multivariate regression on sum-coded between-subjects
+# factors; the intercept tests the within effect itself, and each
+# between factor tests its interaction with it (as car::Anova does
+# for afex).
+
+import itertools
+import json
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# Names emmeans gives polynomial contrasts
+degree_names = ["linear", "quadratic", "cubic", "quartic"]
+
+
+def orthonormal_poly(num_levels):
+    """ Orthonormal polynomial contrasts for equally spaced levels,
+    like R's contr.poly (each column ends on a positive value).
+
+    :type num_levels: int
+    :param num_levels: Number of levels
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    x = np.arange(1, num_levels + 1, dtype=np.float64)
+    vandermonde = np.vander(x - x.mean(), num_levels, increasing=True)
+    q, _ = np.linalg.qr(vandermonde)
+    q = q[:, 1:]
+    return q * np.sign(q[-1])
+
+
+def integer_poly(num_levels, max_degree=6):
+    """ Integer polynomial contrast coefficients, scaled as
+    emmeans' poly.emmc does.
+
+    :type num_levels: int
+    :param num_levels: Number of levels
+
+    :type max_degree: int
+    :param max_degree: Highest degree (emmeans' default is 6)
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    contrasts = orthonormal_poly(num_levels)[:, : min(max_degree, num_levels - 1)]
+    coefficients = []
+    for contrast in contrasts.T:
+        contrast = contrast / contrast[contrast > 0.01].min()
+        z = np.abs(contrast - np.round(contrast)).max()
+        while z > 0.05:
+            contrast = contrast / z
+            z = np.abs(contrast - np.round(contrast)).max()
+        coefficients.append(np.round(contrast))
+    return np.array(coefficients).T
+
+
+def degree_name(degree):
+    """ emmeans' name for a polynomial contrast of a given degree.
+
+    :type degree: int
+    :param degree: Degree, from 1
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    if degree <= len(degree_names):
+        return degree_names[degree - 1]
+    return f"degree {degree}"
+
+
+def sum_coding(num_levels):
+    """ Sum-to-zero coding of a factor, like R's contr.sum.
+
+    :type num_levels: int
+    :param num_levels: Number of levels
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    return np.vstack([np.eye(num_levels - 1), -np.ones(num_levels - 1)])
+
+
+def cell_means(data, subject, dv, between, within):
+    """ Mean of the dependent variable per subject and within-subjects
+    cell.
+
+    :type data: pandas.DataFrame
+    :param data: Trials
+
+    :type subject: string
+    :param subject: Subject column
+
+    :type dv: string
+    :param dv: Dependent variable column
+
+    :type between: list
+    :param between: Between-subjects factor columns
+
+    :type within: list
+    :param within: Within-subjects factor columns
+
+    :raises: ValueError if a subject is missing a cell or is in more
+        than one between-subjects group
+
+    :rtype: tuple
+    """
+    means = data.groupby([subject] + within)[dv].mean().unstack(within)
+    if means.isna().any().any():
+        raise ValueError("Every subject needs data in every within-subjects cell")
+    groups = data.groupby(subject)[between].nunique()
+    if (groups > 1).any().any():
+        raise ValueError("Every subject needs to be in a single between-subjects group")
+    groups = data.groupby(subject)[between].first().reindex(means.index)
+
+    levels = [sorted(data[factor].unique()) for factor in within]
+    means = means.reindex(columns=pd.MultiIndex.from_product(levels))
+    return means.values.reshape([len(means)] + [len(l) for l in levels]), groups, levels
+
+
+def between_design(groups, between):
+    """ Design matrix with an intercept and sum-coded between-subjects
+    factors and their interactions, and the columns of each term.
+
+    :type groups: pandas.DataFrame
+    :param groups: Between-subjects group of each subject
+
+    :type between: list
+    :param between: Between-subjects factor columns
+
+    :raises: N/A
+
+    :rtype: tuple
+    """
+    codings = {}
+    for factor in between:
+        levels = sorted(groups[factor].unique())
+        codes = pd.Categorical(groups[factor], categories=levels).codes
+        codings[factor] = sum_coding(len(levels))[codes]
+
+    columns = [np.ones((len(groups), 1))]
+    terms = {(): [0]}
+    for size in range(1, len(between) + 1):
+        for term in itertools.combinations(between, size):
+            block = codings[term[0]]
+            for factor in term[1:]:
+                block = np.einsum("ni,nj->nij", block, codings[factor]).reshape(
+                    len(groups), -1
+                )
+            start = sum(c.shape[1] for c in columns)
+            terms[term] = list(range(start, start + block.shape[1]))
+            columns.append(block)
+    return np.hstack(columns), terms
+
+
+def within_contrasts(levels, term):
+    """ Orthonormal contrasts, over all within-subjects cells, for a
+    within-subjects term (averaging over the other factors).
+
+    :type levels: list
+    :param levels: Levels of each within-subjects factor
+
+    :type term: tuple
+    :param term: Indices of the factors in the term (empty for none)
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    contrasts = np.ones((1, 1))
+    for i, factor_levels in enumerate(levels):
+        k = len(factor_levels)
+        if i in term:
+            factor_contrasts = orthonormal_poly(k)
+        else:
+            factor_contrasts = np.full((k, 1), 1 / np.sqrt(k))
+        contrasts = np.kron(contrasts, factor_contrasts)
+    return contrasts
+
+
+def mixed_anova(
+    data,
+    subject="Subject ID",
+    dv="Rating",
+    between=("Condition",),
+    within=("Switch Rate", "Stimulus Type"),
+    correction="GG",
+):
+    """ Type III mixed-design ANOVA, like afex::aov_ez with
+    anova_table=list(es="pes").
+
+    :type data: pandas.DataFrame
+    :param data: Trials
+
+    :type subject: string
+    :param subject: Subject column
+
+    :type dv: string
+    :param dv: Dependent variable column
+
+    :type between: list
+    :param between: Between-subjects factor columns
+
+    :type within: list
+    :param within: Within-subjects factor columns
+
+    :type correction: string
+    :param correction: "GG" (Greenhouse-Geisser) or "none"
+
+    :raises: ValueError if the design is incomplete
+
+    :rtype: pandas.DataFrame
+    """
+    between = list(between)
+    within = list(within)
+    means, groups, levels = cell_means(data, subject, dv, between, within)
+    scores = means.reshape(len(means), -1)
+    design, between_terms = between_design(groups, between)
+    num_subjects, num_parameters = design.shape
+    inverse = np.linalg.inv(design.T @ design)
+    coefficients = inverse @ design.T @ scores
+
+    rows = []
+    within_terms = [()]
+    for size in range(1, len(within) + 1):
+        within_terms.extend(itertools.combinations(range(len(within)), size))
+    for within_term in within_terms:
+        contrasts = within_contrasts(levels, within_term)
+        transformed = scores @ contrasts
+        b = coefficients @ contrasts
+        residuals = transformed - design @ b
+        error = residuals.T @ residuals
+        num_contrasts = contrasts.shape[1]
+        error_df = (num_subjects - num_parameters) * num_contrasts
+        if correction == "GG" and num_contrasts > 1:
+            epsilon = np.trace(error) ** 2 / (num_contrasts * np.trace(error @ error))
+        else:
+            epsilon = 1.0
+
+        for between_term, columns in between_terms.items():
+            if not between_term and not within_term:
+                continue  # the grand mean
+            lb = b[columns]
+            hypothesis = lb.T @ np.linalg.solve(inverse[np.ix_(columns, columns)], lb)
+            ss = np.trace(hypothesis)
+            sse = np.trace(error)
+            num_df = len(columns) * num_contrasts
+            f = (ss / num_df) / (sse / error_df)
+            rows.append(
+                {
+                    "Effect": ":".join(
+                        list(between_term) + [within[i] for i in within_term]
+                    ),
+                    "num Df": num_df * epsilon,
+                    "den Df": error_df * epsilon,
+                    "MSE": sse / (error_df * epsilon),
+                    "F": f,
+                    "pes": ss / (ss + sse),
+                    "p.value": stats.f.sf(f, num_df * epsilon, error_df * epsilon),
+                    "SS": ss,
+                    "SSE": sse,
+                    "epsilon": epsilon,
+                }
+            )
+
+    return pd.DataFrame(rows)
+
+
+def poly_contrasts(
+    data,
+    factor="Switch Rate",
+    subject="Subject ID",
+    dv="Rating",
+    between=("Condition",),
+    within=("Switch Rate", "Stimulus Type"),
+    max_degree=6,
+    levels=None,
+):
+    """ Polynomial contrasts over the levels of a within-subjects
+    factor, averaged over the other factors, like
+    contrast(lsmeans(anova_model, specs=factor), method="poly"). The
+    standard errors use the univariate error term of the factor.
+    Like lsmeans, the contrasts run over the levels in the order of
+    the factor's levels, sorted unless given.
+
+    :type data: pandas.DataFrame
+    :param data: Trials
+
+    :type factor: string
+    :param factor: Within-subjects factor
+
+    :type subject: string
+    :param subject: Subject column
+
+    :type dv: string
+    :param dv: Dependent variable column
+
+    :type between: list
+    :param between: Between-subjects factor columns
+
+    :type within: list
+    :param within: Within-subjects factor columns
+
+    :type max_degree: int
+    :param max_degree: Highest degree (emmeans' default is 6)
+
+    :type levels: list
+    :param levels: Levels of the factor in contrast order (default:
+        sorted)
+
+    :raises: ValueError if the design is incomplete or levels aren't
+        the factor's levels
+
+    :rtype: pandas.DataFrame
+    """
+    between = list(between)
+    within = list(within)
+    means, groups, factor_levels = cell_means(data, subject, dv, between, within)
+    axis = 1 + within.index(factor)
+    other_axes = tuple(a for a in range(1, means.ndim) if a != axis)
+    factor_means = means.mean(axis=other_axes)
+    if levels is not None:
+        order = pd.Index(factor_levels[axis - 1]).get_indexer(list(levels))
+        if sorted(order) != list(range(factor_means.shape[1])):
+            raise ValueError(f"Levels don't match the levels of {factor}")
+        factor_means = factor_means[:, order]
+    num_other_cells = int(np.prod([means.shape[a] for a in other_axes]))
+
+    # Marginal means weight every between-subjects group equally
+    group_keys = [tuple(row) for row in groups[between].values]
+    group_index = pd.Index(sorted(set(group_keys)))
+    codes = group_index.get_indexer(group_keys)
+    group_sizes = np.bincount(codes)
+    group_means = np.array(
+        [factor_means[codes == g].mean(axis=0) for g in range(len(group_index))]
+    )
+    marginal_means = group_means.mean(axis=0)
+
+    # Univariate error of the factor, in units of single cells
+    design, _ = between_design(groups, between)
+    contrasts = orthonormal_poly(means.shape[axis])
+    transformed = factor_means @ contrasts
+    b = np.linalg.lstsq(design, transformed, rcond=None)[0]
+    residuals = transformed - design @ b
+    df = (len(means) - design.shape[1]) * contrasts.shape[1]
+    mse = num_other_cells * np.sum(residuals ** 2) / df
+
+    coefficients = integer_poly(means.shape[axis], max_degree)
+    estimates = marginal_means @ coefficients
+    variance_weight = np.sum(1 / group_sizes) / len(group_sizes) ** 2
+    se = np.sqrt(
+        (coefficients ** 2).sum(axis=0) * mse / num_other_cells * variance_weight
+    )
+    t = estimates / se
+    return pd.DataFrame(
+        {
+            "contrast": [degree_name(d + 1) for d in range(coefficients.shape[1])],
+            "estimate": estimates,
+            "SE": se,
+            "df": df,
+            "t.ratio": t,
+            "p.value": 2 * stats.t.sf(np.abs(t), df),
+        }
+    )
+
+
+def read_reference(file_name):
+    """ Reads stored reference results (e.g., afex output).
+
+    :type file_name: string
+    :param file_name: Path of the JSON file
+
+    :raises: N/A
+
+    :rtype: dict
+    """
+    with open(file_name, "r") as fp:
+        return json.load(fp)
+
+
+def compare_to_reference(results, reference, key, columns, tolerance):
+    """ Differences between results and stored reference values
+    (e.g., afex output), with whether each is within tolerance.
+
+    :type results: pandas.DataFrame
+    :param results: Results from mixed_anova or poly_contrasts
+
+    :type reference: list
+    :param reference: Reference rows (dicts)
+
+    :type key: string
+    :param key: Column identifying rows ("Effect" or "contrast")
+
+    :type columns: list
+    :param columns: Columns to compare
+
+    :type tolerance: dict
+    :param tolerance: Largest allowed absolute difference per column
+
+    :raises: KeyError if a reference row has no matching result
+
+    :rtype: pandas.DataFrame
+    """
+    results = results.set_index(key)
+    rows = []
+    for expected in reference:
+        actual = results.loc[expected[key]]
+        for column in columns:
+            difference = actual[column] - expected[column]
+            rows.append(
+                {
+                    key: expected[key],
+                    "column": column,
+                    "expected": expected[column],
+                    "actual": actual[column],
+                    "ok": abs(difference) <= tolerance[column],
+                }
+            )
+    return pd.DataFrame(rows)
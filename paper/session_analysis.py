@@ -0,0 +1,177 @@
+# Whole-dataset analyses of session data.
+#
+# Each analysis works on all subjects at once (pivots, merges and
+# grouped sums) rather than looping over subjects and appending to
+# a DataFrame.
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+def in_subject_order(results, data, column="subject_id"):
+    """ Sorts per-subject results into the order subjects appear in
+    the data, keeping the order of rows within each subject.
+
+    :type results: pandas.DataFrame
+    :param results: Results with a subject ID column
+
+    :type data: pandas.DataFrame
+    :param data: Trials
+
+    :type column: string
+    :param column: Subject ID column of the results
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    order = pd.Index(data["Subject ID"].unique())
+    positions = order.get_indexer(results[column])
+    return results.iloc[np.argsort(positions, kind="mergesort")].reset_index(drop=True)
+
+
+def paired_ratings(data):
+    """ First and repeat rating of each repeated stimulus, one row
+    per (Subject ID, Start Date, File Name), so that a subject ID
+    reused across sessions pairs ratings within each session. Stimuli
+    missing either rating are left out, so subjects with discarded
+    trials still pair up.
+
+    :type data: pandas.DataFrame
+    :param data: Trials, with a "Repeat Trial" column
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    pairs = data.pivot_table(
+        index=["Subject ID", "Start Date", "File Name"],
+        columns="Repeat Trial",
+        values="Rating",
+        aggfunc="first",
+    )
+    pairs = pairs.reindex(columns=[False, True])
+    pairs.columns = ["first_rating", "second_rating"]
+    return pairs.dropna().reset_index()
+
+
+def pearson_by_group(groups, x, y):
+    """ Pearson r, two-sided p-value and Fisher z per group, from
+    grouped sums.
+
+    :type groups: pandas.Series
+    :param groups: Group of each pair
+
+    :type x: pandas.Series
+    :param x: First values
+
+    :type y: pandas.Series
+    :param y: Second values
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    sums = pd.DataFrame(
+        {"n": 1, "x": x, "y": y, "xx": x * x, "yy": y * y, "xy": x * y}
+    ).groupby(groups.values).sum()
+    n = sums["n"].values.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sxy = sums["xy"].values - sums["x"].values * sums["y"].values / n
+        sxx = sums["xx"].values - sums["x"].values ** 2 / n
+        syy = sums["yy"].values - sums["y"].values ** 2 / n
+        r = np.clip(sxy / np.sqrt(sxx * syy), -1.0, 1.0)
+        df = n - 2
+        t = r * np.sqrt(df / (1.0 - r * r))
+        p = 2 * stats.t.sf(np.abs(t), df)
+        z = np.arctanh(r)
+    p[np.abs(r) == 1] = 0.0
+    return pd.DataFrame(
+        {"n": sums["n"].values, "correlation": r, "p-value": p, "fisher_z": z},
+        index=sums.index,
+    )
+
+
+def subject_reliability(data):
+    """ Test-retest reliability of each subject: the correlation
+    between first and repeat ratings of the repeated stimuli. Ratings
+    are paired within each session (see paired_ratings), but the
+    correlation pools all of a subject ID's pairs, so a subject ID
+    reused across sessions gets a single correlation and is kept or
+    excluded as a whole.
+
+    :type data: pandas.DataFrame
+    :param data: Trials, with a "Repeat Trial" column
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    pairs = paired_ratings(data)
+    correlations = pearson_by_group(
+        pairs["Subject ID"], pairs["first_rating"], pairs["second_rating"]
+    )
+    conditions = data.groupby("Subject ID", sort=False)["Condition"].first()
+    reliability = pd.DataFrame(
+        {
+            "subject_id": correlations.index,
+            "condition": conditions.reindex(correlations.index).values,
+            "correlation": correlations["correlation"].values,
+            "p-value": correlations["p-value"].values,
+            "fisher_z": correlations["fisher_z"].values,
+        }
+    )
+    return in_subject_order(reliability, data)
+
+
+def repeated_differences(data):
+    """ Ratings and RTs of each repeated stimulus in block 1 and in
+    block 2, and their differences (block 2 minus block 1), for all
+    subjects at once. Trials are matched on (Subject ID, Start Date,
+    File Name).
+
+    :type data: pandas.DataFrame
+    :param data: Trials
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    key = ["Subject ID", "Start Date", "File Name"]
+    columns = key + ["Condition", "Rating", "RT"]
+    first = data.loc[data["Block #"] == 1, columns]
+    second = data.loc[data["Block #"] == 2, columns]
+    pairs = first.merge(
+        second.drop(columns="Condition"), on=key, suffixes=(" 1", " 2")
+    ).sort_values(["Subject ID", "Start Date", "File Name"], kind="mergesort")
+
+    differences = pd.DataFrame(
+        {
+            "subject_id": pairs["Subject ID"].values,
+            "condition": pairs["Condition"].values,
+            "first_ratings": pairs["Rating 1"].values.astype(np.float64),
+            "second_ratings": pairs["Rating 2"].values.astype(np.float64),
+            "first_RTs": pairs["RT 1"].values.astype(np.float64),
+            "second_RTs": pairs["RT 2"].values.astype(np.float64),
+        }
+    )
+    differences["differences"] = (
+        differences["second_ratings"] - differences["first_ratings"]
+    )
+    differences["RT_differences"] = differences["second_RTs"] - differences["first_RTs"]
+    differences = differences[
+        [
+            "subject_id",
+            "condition",
+            "first_ratings",
+            "second_ratings",
+            "differences",
+            "first_RTs",
+            "second_RTs",
+            "RT_differences",
+        ]
+    ]
+    return in_subject_order(differences, data)
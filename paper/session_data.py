@@ -0,0 +1,136 @@
+# Reading session data files.
+#
+# Reads every session's tab-separated data file in parallel with
+# explicit column types and concatenates them once, instead of
+# growing a DataFrame file by file. "None" ratings (and RTs) become
+# NaN while parsing. Rating history files are read the same way.
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+separator = "\t"
+
+# Column types of the data files written by code/sound_switch_expt_1.py
+column_dtypes = {
+    "Subject ID": np.int64,
+    "Condition": str,
+    "Block #": np.int64,
+    "Trial #": np.int64,
+    "Switch Rate": np.float64,
+    "Exemplar": np.int64,
+    "File Name": str,
+    "Rating": np.float64,
+    "RT": np.float64,
+    "Rating History": str,
+    "Trial Duration": np.float64,
+    "Block Duration": np.float64,
+    "Session Duration": np.float64,
+    "Experiment Duration": np.float64,
+    "Scheduled Onset": np.float64,
+    "Actual Onset": np.float64,
+    "Playback Duration": np.float64,
+    "Dropped Frames": np.int64,
+    "Start Date": str,
+    "Experiment": str,
+    "Testing Location": str,
+    "Experimenter Initials": str,
+    "Subject Initials": str,
+}
+
+# Values written for missing responses
+missing_values = {"Rating": ["None"], "RT": ["None"]}
+
+# Column types of the rating history files written next to each data
+# file (<data file name without .txt>.history.tsv, see
+# make_history_file in code/stefan_utils.py)
+history_extension = ".history.tsv"
+history_dtypes = {
+    "Subject ID": np.int64,
+    "Trial #": np.int64,
+    "Step": np.int64,
+    "Value": np.float64,
+    "Time": np.float64,
+}
+
+
+def read_session(file_name):
+    """ Reads one session's data file.
+
+    :type file_name: string
+    :param file_name: Path of the data file
+
+    :raises: ValueError if a column doesn't match its type
+
+    :rtype: pandas.DataFrame
+    """
+    return pd.read_csv(
+        file_name,
+        sep=separator,
+        dtype=column_dtypes,
+        na_values=missing_values,
+        keep_default_na=False,
+    )
+
+
+def read_sessions(file_names, num_workers=None):
+    """ Reads many sessions' data files in parallel into one frame.
+
+    :type file_names: list
+    :param file_names: Paths of the data files
+
+    :type num_workers: int
+    :param num_workers: Number of threads (default: ThreadPoolExecutor's)
+
+    :raises: ValueError if a column doesn't match its type
+
+    :rtype: pandas.DataFrame
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        sessions = list(executor.map(read_session, file_names))
+    if not sessions:
+        return pd.DataFrame(columns=list(column_dtypes))
+    return pd.concat(sessions, ignore_index=True, sort=False)
+
+
+def read_history(file_name):
+    """ Reads one session's rating history file. Missing ratings
+    ("NaN") become NaN.
+
+    :type file_name: string
+    :param file_name: Path of the history file
+
+    :raises: ValueError if a column doesn't match its type
+
+    :rtype: pandas.DataFrame
+    """
+    return pd.read_csv(
+        file_name,
+        sep=separator,
+        dtype=history_dtypes,
+        na_values={"Value": ["NaN"]},
+        keep_default_na=False,
+    )
+
+
+def read_histories(file_names, num_workers=None):
+    """ Reads many sessions' rating history files in parallel into
+    one frame.
+
+    :type file_names: list
+    :param file_names: Paths of the history files
+
+    :type num_workers: int
+    :param num_workers: Number of threads (default: ThreadPoolExecutor's)
+
+    :raises: ValueError if a column doesn't match its type
+
+    :rtype: pandas.DataFrame
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        histories = list(executor.map(read_history, file_names))
+    if not histories:
+        return pd.DataFrame(
+            {column: pd.Series(dtype=dtype) for column, dtype in history_dtypes.items()}
+        )
+    return pd.concat(histories, ignore_index=True, sort=False)
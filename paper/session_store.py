@@ -0,0 +1,261 @@
+# Incremental columnar store of session data.
+#
+# Each data/YYYY-MM-DD/ snapshot holds copies of every earlier
+# session, so re-reading a whole snapshot on every run mostly
+# re-parses files that haven't changed. The store keeps one Parquet
+# file per condition and an index of the content hashes it has
+# ingested: an update only reads files with new content, sessions
+# are deduplicated by (Subject ID, Start Date), and loading the
+# store is a handful of columnar reads.
+#
+# Usage: python session_store.py store_dir data_file [...]
+
+from concurrent.futures import ThreadPoolExecutor
+from session_data import read_session
+import glob
+import hashlib
+import json
+import os
+import pandas as pd
+import sys
+
+index_name = "index.json"
+partition_name = "sessions.parquet"
+session_key = ["Subject ID", "Start Date"]
+sort_order = ["Subject ID", "Start Date", "Trial #"]
+
+
+def file_hash(file_name):
+    """ SHA-256 of a file's contents.
+
+    :type file_name: string
+    :param file_name: Path of the file
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def partition_path(store_dir, condition):
+    """ Path of a condition's partition.
+
+    :type store_dir: string
+    :param store_dir: Directory of the store
+
+    :type condition: string
+    :param condition: Condition (e.g., "beautiful")
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    return os.path.join(store_dir, f"condition={condition}", partition_name)
+
+
+def read_index(store_dir):
+    """ Reads the store's index, or an empty one.
+
+    :type store_dir: string
+    :param store_dir: Directory of the store
+
+    :raises: N/A
+
+    :rtype: dict
+    """
+    try:
+        with open(os.path.join(store_dir, index_name), "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {"files": {}, "sessions": {}, "duplicates": {}}
+
+
+def write_index(store_dir, index):
+    """ Atomically replaces the store's index.
+
+    :type store_dir: string
+    :param store_dir: Directory of the store
+
+    :type index: dict
+    :param index: Index to write
+
+    :raises: N/A
+
+    :rtype: void
+    """
+    temp_file_name = os.path.join(store_dir, f"{index_name}.tmp")
+    with open(temp_file_name, "w") as fp:
+        json.dump(index, fp, indent=1, sort_keys=True)
+    os.replace(temp_file_name, os.path.join(store_dir, index_name))
+
+
+def current_hashes(file_names, index):
+    """ Content hash of each file, reusing the hash recorded in the
+    index if the file's size and modification time haven't changed.
+    Updates index["files"].
+
+    :type file_names: list
+    :param file_names: Paths of the data files
+
+    :type index: dict
+    :param index: The store's index
+
+    :raises: N/A
+
+    :rtype: dict
+    """
+    files = {}
+    for file_name in file_names:
+        stat = os.stat(file_name)
+        known = index["files"].get(file_name)
+        if (
+            known is None
+            or known["size"] != stat.st_size
+            or known["mtime_ns"] != stat.st_mtime_ns
+        ):
+            known = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "hash": file_hash(file_name),
+            }
+        files[file_name] = known
+    index["files"] = files
+    return {file_name: known["hash"] for file_name, known in files.items()}
+
+
+def update_store(file_names, store_dir, num_workers=None):
+    """ Brings the store in line with the given data files. Only
+    files with new contents are read; sessions whose files are gone
+    are dropped. If several files hold the same session, the one with
+    the most trials is kept.
+
+    :type file_names: list
+    :param file_names: Paths of the data files
+
+    :type store_dir: string
+    :param store_dir: Directory of the store
+
+    :type num_workers: int
+    :param num_workers: Number of threads reading files
+
+    :raises: ValueError if a file's columns don't match their types
+
+    :rtype: dict
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    index = read_index(store_dir)
+    hashes = current_hashes(file_names, index)
+    live_hashes = set(hashes.values())
+
+    # Drop sessions whose files are gone; duplicates of them may now
+    # have to be stored instead
+    stale = {h: s for h, s in index["sessions"].items() if h not in live_hashes}
+    stale_keys = {(s["Subject ID"], s["Start Date"]) for s in stale.values()}
+    for h in stale:
+        del index["sessions"][h]
+    index["duplicates"] = {
+        h: s
+        for h, s in index["duplicates"].items()
+        if h in live_hashes and (s["Subject ID"], s["Start Date"]) not in stale_keys
+    }
+
+    new_files = {}
+    for file_name, h in hashes.items():
+        if h not in index["sessions"] and h not in index["duplicates"]:
+            new_files.setdefault(h, file_name)
+    summary = {"read": len(new_files), "dropped": len(stale)}
+    if not new_files and not stale:
+        write_index(store_dir, index)
+        return summary
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        sessions = list(executor.map(read_session, new_files.values()))
+    new_data = [
+        session.assign(**{"Source Hash": h})
+        for h, session in zip(new_files, sessions)
+    ]
+
+    conditions = {s["Condition"] for s in stale.values()}
+    for session in new_data:
+        conditions.update(session["Condition"].unique())
+    for condition in conditions:
+        path = partition_path(store_dir, condition)
+        parts = [
+            session[session["Condition"] == condition] for session in new_data
+        ]
+        if os.path.exists(path):
+            stored = pd.read_parquet(path)
+            parts.insert(0, stored[~stored["Source Hash"].isin(stale)])
+        data = pd.concat(parts, ignore_index=True, sort=False)
+
+        # Keep one file per session: the one with the most trials,
+        # or the one stored first
+        counts = (
+            data.groupby(session_key + ["Source Hash"], sort=False)
+            .size()
+            .reset_index(name="num_trials")
+        )
+        counts = counts.sort_values("num_trials", ascending=False, kind="mergesort")
+        kept = set(counts.drop_duplicates(session_key)["Source Hash"])
+        for subject_id, start_date, h, num_trials in counts.itertuples(index=False):
+            info = {
+                "Subject ID": int(subject_id),
+                "Start Date": start_date,
+                "Condition": condition,
+            }
+            if h in kept:
+                index["sessions"][h] = info
+                index["duplicates"].pop(h, None)
+            else:
+                index["duplicates"][h] = info
+                index["sessions"].pop(h, None)
+        data = data[data["Source Hash"].isin(kept)]
+        data = data.sort_values(sort_order, kind="mergesort")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if data.empty:
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        temp_file_name = f"{path}.tmp"
+        data.to_parquet(temp_file_name, index=False)
+        os.replace(temp_file_name, path)
+
+    write_index(store_dir, index)
+    return summary
+
+
+def load_store(store_dir, conditions=None):
+    """ Loads the stored sessions.
+
+    :type store_dir: string
+    :param store_dir: Directory of the store
+
+    :type conditions: list
+    :param conditions: Conditions to load (default: all)
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    if conditions is None:
+        paths = sorted(glob.glob(partition_path(store_dir, "*")))
+    else:
+        paths = [partition_path(store_dir, condition) for condition in conditions]
+        paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return pd.DataFrame()
+    data = pd.concat(
+        [pd.read_parquet(path) for path in paths], ignore_index=True, sort=False
+    )
+    return data.drop(columns=["Source Hash"])
+
+
+if __name__ == "__main__":
+    summary = update_store(sys.argv[2:], sys.argv[1])
+    print(f"Read {summary['read']} new files, dropped {summary['dropped']} sessions")
@@ -132,26 +132,29 @@ from IPython.display import SVG, display, Markdown
 
 # %%
 import glob, os
+from session_store import load_store, update_store
 
-separator = r"\t"
 data_dir = "../data/2019-04-18"
+store_dir = "../data/session_store"
 prefix = "Sound Switch"
 extension = ".txt"
 search = f"{data_dir}/{prefix}*{extension}"
 
-# Get each subject's data and concatenate into 
-# one larger DataFrame
-all_data = pd.DataFrame()
-for file_name in glob.glob(search):
-    subject_data = pd.read_csv(file_name, sep=separator)
-    if all_data.shape == (0, 0):
-        all_data = subject_data
-    else: 
-        all_data = all_data.append(subject_data)
-
-all_data.reset_index(inplace=True, drop=True)
+# Bring the columnar store in line with the data directory (only
+# files with new contents are read), then load every subject's
+# data into one larger DataFrame
+update_store(glob.glob(search), store_dir)
+all_data = load_store(store_dir)
 all_data.head()
 
+# %%
+# Rating histories, one row per step, from the .history.tsv files
+# written next to newer sessions' data files
+from session_data import history_extension, read_histories
+
+history_data = read_histories(glob.glob(f"{data_dir}/{prefix}*{history_extension}"))
+history_data.head()
+
 # %% [markdown]
 # ### Demographics
 # Race demographics are borked for the moment; will fix later.
@@ -189,13 +192,14 @@ debriefing_data["Age"].describe().round(2)
 # #### Determine stimulus type
 
 # %%
-def get_stimulus_type(row):
-    """
-    All stimuli under 10 are guitar; the rest are tones.
-    """
-    return "guitar" if row["Exemplar"] < 10 else "tone"
+# Stimulus type, chunk size, etc. come from the stimulus catalog,
+# which parses the stimulus file names and Notes.txt (exemplars
+# 00-09 are guitar, 10-19 are tones) once
+from stimulus_catalog import build_catalog, join_catalog
 
-all_data["Stimulus Type"] = all_data.apply(get_stimulus_type, axis=1)
+stimulus_dir = "../stimuli/combined"
+stimulus_catalog = build_catalog(stimulus_dir)
+all_data = join_catalog(all_data, stimulus_catalog)
 all_data.head()
 
 # %% [markdown]
@@ -211,68 +215,23 @@ all_data.head()
 
 # %% [markdown]
 # #### Remove subjects with "None" ratings
+# "None" ratings are read in as NaN.
 
 # %%
-subjects_with_missing_data = all_data[all_data["Rating"] == "None"]["Subject ID"]
+subjects_with_missing_data = all_data[all_data["Rating"].isna()]["Subject ID"]
 print(f"Bad subjects: \n {subjects_with_missing_data}")
 all_data = all_data[~all_data["Subject ID"].isin(subjects_with_missing_data)]
 
-# %% [markdown]
-# #### Re-convert ratings to numeric
-
-# %%
-all_data["Rating"] = pd.to_numeric(all_data["Rating"])
-
 # %% [markdown]
 # #### Get subject reliability
 
 # %%
-subject_reliability_df = pd.DataFrame(
-    index=[],
-    columns=[
-        "subject_id",
-        "condition",        
-        "correlation",
-        "p-value",
-        "fisher_z",
-    ],
-)
-subject_ids = all_data["Subject ID"].unique()
-for subject_id in subject_ids:
-    subject_data = all_data >> mask(X["Subject ID"] == subject_id)
-    subject_data.sort_values(by=["File Name"], inplace=True)
-    repeated_stimuli = (
-        subject_data 
-        >> mask(X["Repeat Trial"] == True)
-        >> select(["File Name"])
-    )
-    
-    first_ratings_data = subject_data[
-        (subject_data["File Name"].isin(repeated_stimuli["File Name"]))
-        & (subject_data["Repeat Trial"] == False)
-    ]["Rating"].tolist()
-    
-    second_ratings_data = subject_data[
-        (subject_data["File Name"].isin(repeated_stimuli["File Name"]))
-        & (subject_data["Repeat Trial"] == True)
-    ]["Rating"].tolist()
-    
-    subject_reliability_corr = scipy.stats.pearsonr(
-        first_ratings_data, second_ratings_data
-    )
-    
-    # Needs to be in arrays for pandas
-    # XXX break down by stimulus type?
-    this_corr_row = {
-        "subject_id": [subject_id],
-        "condition": [subject_data["Condition"].iloc[0]],        
-        "correlation": [subject_reliability_corr[0]],
-        "p-value": [subject_reliability_corr[1]],
-        "fisher_z": [np.arctanh(subject_reliability_corr[0])],
-    }
-    this_corr_row = pd.DataFrame.from_dict(this_corr_row)
-    subject_reliability_df = subject_reliability_df.append(this_corr_row)
-    
+from session_analysis import subject_reliability
+
+# Pairs first and repeat ratings by file name for all subjects at
+# once; stimuli missing either rating are left out
+# XXX break down by stimulus type?
+subject_reliability_df = subject_reliability(all_data)
 subject_reliability_df.round(3)
 
 # %% [markdown]
@@ -313,23 +272,43 @@ results_for_plot = (
 )
 
 # %%
+from bootstrap_ci import bootstrap_ci
+
+bootstrap_cache_dir = "../data/bootstrap_cache"
+
 def plot_results(data):
+    # Intervals come from bootstrapping subjects (see bootstrap_ci.py),
+    # computed once per data set and cached, rather than from seaborn
+    # bootstrapping every cell on every plot.
+    intervals = bootstrap_ci(data, cache_dir=bootstrap_cache_dir)
+    stimulus_types = data["Stimulus Type"].unique()
+    colors = dict(zip(stimulus_types, sns.color_palette()))
     f, ax = plt.subplots(2, 1, figsize=(8, 12), sharex=True)
     sns.despine()
     for i, condition in enumerate(data["Condition"].unique()):
-        these_results = data >> mask(X["Condition"] == condition)
-        # Convert complexity labels to more informative string labels.
-        # Note that seaborn has problems with numbers as categories, 
-        # and simple string conversion via `str` doesn't work.    
-        sns.lineplot(
-            x="Switch Rate",
-            y="Rating",
-            hue="Stimulus Type",
-            data=these_results,
-            ax=ax[i],
-            linewidth=4,
-            ci=95
-        )
+        these_intervals = intervals >> mask(X["Condition"] == condition)
+        for stimulus_type in stimulus_types:
+            curve = (
+                these_intervals
+                >> mask(X["Stimulus Type"] == stimulus_type)
+                >> arrange(X["Switch Rate"])
+            )
+            ax[i].plot(
+                curve["Switch Rate"],
+                curve["Mean"],
+                color=colors[stimulus_type],
+                linewidth=4,
+                label=stimulus_type
+            )
+            ax[i].fill_between(
+                curve["Switch Rate"],
+                curve["CI Lower"],
+                curve["CI Upper"],
+                color=colors[stimulus_type],
+                alpha=0.2,
+                linewidth=0
+            )
+        ax[i].legend(title="Stimulus Type")
         ax[i].set_title(f"'{condition.title()}' Results")
         ax[i].set(xlabel='Switch Rate', ylabel='Mean Rating')    
     plt.show()
@@ -343,55 +322,65 @@ plot_results(results_for_plot)
 # #### Mixed measures ANOVA.
 
 # %%
-# %load_ext rpy2.ipython
-
-# %%
-# Convert data to R format
-from rpy2.robjects import pandas2ri
+# Same model as afex::aov_ez(between="Condition",
+# within=c("Switch.Rate", "Stimulus.Type"), type=3, es="pes"),
+# computed in-process instead of through rpy2
+from mixed_anova import (
+    compare_to_reference,
+    mixed_anova,
+    poly_contrasts,
+    read_reference,
+)
 
-R_data = no_repeat_data >> select(
-    X["Subject ID"],
-    X["Condition"],
-    X["Stimulus Type"],
-    X["Switch Rate"],
-    X["Rating"],
+anova_model = mixed_anova(
+    no_repeat_data,
+    subject="Subject ID",
+    dv="Rating",
+    between=["Condition"],
+    within=["Switch Rate", "Stimulus Type"],
 )
-R_data = pandas2ri.py2ri(R_data)
-R_data.head()
+anova_model.round(3)
 
-# %% {"magic_args": "-i R_data -o anova_model,anova_model_summary,ref_poly,poly_contrasts", "language": "R"}
-# library(afex)
-# library(lsmeans)
-# # afex_options(emmeans_model = "multivariate")
-# # afex_options("emmeans_mode")
-# # model = afex_options("emmeans_model")
-#
-# # Convert to numeric, due to pandas converting everything to strings
-# R_data <- transform(R_data, Subject.ID = as.numeric(Subject.ID))
-# R_data <- transform(R_data, Rating = as.numeric(Rating))
-# R_data <- transform(R_data, Switch.Rate = as.numeric(Switch.Rate))
-# anova_model <- aov_ez(
-#     "Subject.ID",
-#     "Rating",
-#     R_data,
-#     between=c("Condition"),
-#     within=c("Switch.Rate", "Stimulus.Type"),
-#     type=3, # type of sum squares to use; default is 3,
-#     anova_table=list(es = "pes") # partial eta-squared; default is ges (generalized)
-# )
-# anova_model_summary <- summary(anova_model)
-# anova_model_names <- names(summary(anova_model))
-# ref_poly <- lsmeans(anova_model, specs = c("Switch.Rate"))
-# poly_contrasts <- contrast(ref_poly,method="poly")
+# %% [markdown]
+# Cross-check against the afex output stored from the last R run.
 
 # %%
-print(anova_model)
+afex_reference = read_reference("afex_reference.json")
+anova_check = compare_to_reference(
+    anova_model,
+    afex_reference["anova"],
+    key="Effect",
+    columns=["num Df", "den Df", "MSE", "F", "pes"],
+    tolerance={"num Df": 0.005, "den Df": 0.005, "MSE": 0.005, "F": 0.005, "pes": 0.005},
+)
+print(f"Matches afex: {anova_check['ok'].all()}")
 
 # %% [markdown]
 # To reproduce our smallest observed effect size at 80% power, we'd need a sample size of 18 (per question condition) according to GPower. XXX Need to check via other means as well. XXX
 
 # %%
-print(poly_contrasts)
+# rpy2 turned Switch Rate into a factor with levels in order of first
+# appearance, and as.numeric() took its level codes, so the stored
+# lsmeans contrasts ran over the switch rates in that order rather
+# than sorted. The order is stored with them; pass levels=None for
+# contrasts over sorted switch rates.
+poly_contrasts_df = poly_contrasts(
+    no_repeat_data,
+    factor="Switch Rate",
+    levels=afex_reference["poly_contrast_levels"],
+)
+poly_contrasts_df.round(3)
+
+# %%
+# Stored estimates are rounded to 0.1
+contrast_check = compare_to_reference(
+    poly_contrasts_df,
+    afex_reference["poly_contrasts"],
+    key="contrast",
+    columns=["estimate", "SE", "df"],
+    tolerance={"estimate": 0.05, "SE": 0.005, "df": 0},
+)
+print(f"Matches lsmeans: {contrast_check['ok'].all()}")
 
 # %% [markdown]
 # XXX Contrasts are not interpretable right now, since it collapses across both condition and stimulus type. Will need to separate those out.
@@ -438,7 +427,10 @@ for subject_id in subject_ids:
 # %%
 test_sanity = False
 if test_sanity:
-    from pydub import AudioSegment
+    import sys
+
+    sys.path.append("../code")
+    from audio_decoding import decode_many
 
     stimulus_dir = "../stimuli/combined"
     prefix = "switch-"
@@ -446,9 +438,8 @@ if test_sanity:
     search = f"{stimulus_dir}/{prefix}*{extension}"
 
     song_durations = []
-    for song_name in glob.glob(search):
-        song = AudioSegment.from_mp3(song_name)
-        song_durations.append(len(song))
+    for frames, frame_rate in decode_many(glob.glob(search)):
+        song_durations.append(round(1000 * len(frames) / frame_rate))
 
     print(set(song_durations))
 
@@ -558,82 +549,11 @@ for i, df in enumerate(dfs):
 # ## Are repeated stimuli liked more the first time they are shown?
 
 # %%
-template_df = pd.DataFrame(
-    index=[],
-    columns=[
-        "subject_id",
-        "condition",
-        "first_ratings",
-        "second_ratings",
-        "differences",
-        "first_RTs",
-        "second_RTs",
-        "RT_differences",
-    ],
-)
-
-repeated_differences_df = template_df.copy(deep=True)
-
-subject_ids = all_data["Subject ID"].unique()
-for subject_id in subject_ids:
-    subject_df = template_df.copy(deep=True)
-    subject_data = all_data >> mask(X["Subject ID"] == subject_id)
-    subject_data.sort_values(by=["File Name"], inplace=True)
-    repeated_stimuli = (
-        subject_data >> mask(X["Repeat Trial"] == True) >> select(["File Name"])
-    )
-
-    subject_df["first_ratings"] = np.array(
-        subject_data[
-            (subject_data["File Name"].isin(repeated_stimuli["File Name"]))
-            & (subject_data["Repeat Trial"] == False)
-        ]["Rating"].tolist()
-    )
-
-    subject_df["second_ratings"] = np.array(
-        subject_data[
-            (subject_data["File Name"].isin(repeated_stimuli["File Name"]))
-            & (subject_data["Repeat Trial"] == True)
-        ]["Rating"].tolist()
-    )
+from session_analysis import repeated_differences
 
-    subject_df["first_RTs"] = np.array(
-        subject_data[
-            (subject_data["File Name"].isin(repeated_stimuli["File Name"]))
-            & (subject_data["Repeat Trial"] == False)
-        ]["RT"].tolist()
-    )
-
-    subject_df["second_RTs"] = np.array(
-        subject_data[
-            (subject_data["File Name"].isin(repeated_stimuli["File Name"]))
-            & (subject_data["Repeat Trial"] == True)
-        ]["RT"].tolist()
-    )
-
-    subject_df["differences"] = (
-        subject_df["second_ratings"] - subject_df["first_ratings"]
-    )
-    subject_df["RT_differences"] = (
-        subject_df["second_RTs"] - subject_df["first_RTs"]
-    )
-    subject_df["subject_id"] = subject_id
-    subject_df["condition"] = subject_data["Condition"].iloc[0]
-
-    repeated_differences_df = repeated_differences_df.append(subject_df)
-
-# Convert to numeric type, since it's all objects for some reason
-cols = [
-    "first_ratings",
-    "second_ratings",
-    "differences",
-    "first_RTs",
-    "second_RTs",
-    "RT_differences",
-]
-repeated_differences_df[cols] = repeated_differences_df[cols].apply(
-    pd.to_numeric
-)
+# Matches block 1 and block 2 trials of each repeated stimulus
+# for all subjects at once
+repeated_differences_df = repeated_differences(all_data)
 repeated_differences_df.head()
 
 # %%
@@ -0,0 +1,165 @@
+# Catalog of the stimuli, derived from their file names.
+#
+# generate_songs encodes each stimulus's switch rate, chunk size,
+# tones and exemplar in its file name (e.g.,
+# switch-0.3_chunk-500_C_G_alternating_10.mp3), and the stimulus
+# directory's Notes.txt says which exemplars are guitar chords and
+# which are pure tones (read by code/stimulus_notes.py, as in the
+# experiment's stimulus bank). The catalog parses every file name
+# once into a table with one row (and integer code) per stimulus;
+# trials are joined to it by code rather than by calling Python on
+# each row.
+
+import glob
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code")
+sys.path.append(code_dir)
+import stimulus_notes
+
+file_name_pattern = (
+    r"switch-(?P<rate>[0-9.]+)_chunk-(?P<chunk>[0-9]+)_"
+    r"(?P<tones>.+)_alternating_(?P<exemplar>[0-9]+)\.(?P<extension>\w+)$"
+)
+
+catalog_columns = [
+    "Stimulus Code",
+    "Stimulus Name",
+    "Switch Rate",
+    "Chunk Size",
+    "Tones",
+    "Exemplar",
+    "Stimulus Type",
+]
+
+
+def read_notes(notes_file_name):
+    """ Exemplar ranges of each stimulus type, from Notes.txt.
+
+    :type notes_file_name: string
+    :param notes_file_name: Path of Notes.txt
+
+    :raises: ValueError if the notes don't name any ranges
+
+    :rtype: pandas.DataFrame
+    """
+    ranges = stimulus_notes.read_notes(notes_file_name)
+    return pd.DataFrame(ranges, columns=["First", "Last", "Stimulus Type"])
+
+
+def stimulus_types(exemplars, ranges):
+    """ Stimulus type of each exemplar.
+
+    :type exemplars: numpy.ndarray
+    :param exemplars: Exemplar indices
+
+    :type ranges: pandas.DataFrame
+    :param ranges: Exemplar ranges, as returned by read_notes
+
+    :raises: ValueError if an exemplar isn't in any range
+
+    :rtype: pandas.Categorical
+    """
+    ranges = ranges.sort_values("First")
+    which = np.searchsorted(ranges["First"].values, exemplars, side="right") - 1
+    inside = (which >= 0) & (
+        exemplars <= ranges["Last"].values[np.clip(which, 0, None)]
+    )
+    if not inside.all():
+        missing = sorted(set(exemplars[~inside]))
+        raise ValueError(f"Exemplars not in Notes.txt: {missing}")
+    types = ranges["Stimulus Type"].values[which]
+    return pd.Categorical(types, categories=sorted(set(ranges["Stimulus Type"])))
+
+
+def build_catalog(stimulus_dir):
+    """ Catalog of the stimuli in a directory, sorted by switch rate
+    and exemplar. Files not named by generate_songs (e.g., the
+    practice song) are left out.
+
+    :type stimulus_dir: string
+    :param stimulus_dir: Directory with the stimuli and Notes.txt
+
+    :raises: ValueError if an exemplar isn't in Notes.txt
+
+    :rtype: pandas.DataFrame
+    """
+    file_names = glob.glob(os.path.join(stimulus_dir, "*"))
+    names = pd.Series(sorted(os.path.basename(f) for f in file_names))
+    parts = names.str.extract(file_name_pattern)
+    parsed = parts["rate"].notna()
+    names, parts = names[parsed], parts[parsed]
+
+    catalog = pd.DataFrame(
+        {
+            "Stimulus Name": names.values,
+            "Switch Rate": parts["rate"].astype(np.float64).values,
+            "Chunk Size": parts["chunk"].astype(np.int64).values,
+            "Tones": pd.Categorical(parts["tones"].values),
+            "Exemplar": parts["exemplar"].astype(np.int64).values,
+        }
+    )
+    ranges = read_notes(os.path.join(stimulus_dir, stimulus_notes.notes_name))
+    catalog["Stimulus Type"] = stimulus_types(catalog["Exemplar"].values, ranges)
+    catalog = catalog.sort_values(["Switch Rate", "Exemplar"], kind="mergesort")
+    catalog["Stimulus Code"] = np.arange(len(catalog), dtype=np.int64)
+    return catalog[catalog_columns].reset_index(drop=True)
+
+
+def stimulus_codes(file_names, catalog):
+    """ Catalog code of each file name (-1 if not in the catalog). Only
+    the distinct file names are parsed.
+
+    :type file_names: pandas.Series
+    :param file_names: Paths of the stimuli (e.g., the "File Name" column)
+
+    :type catalog: pandas.DataFrame
+    :param catalog: Catalog, as returned by build_catalog
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    file_names = pd.Categorical(file_names)
+    # Stimuli were named with forward slashes on every platform
+    category_names = [
+        os.path.basename(f.replace("\\", "/")) for f in file_names.categories
+    ]
+    positions = pd.Index(catalog["Stimulus Name"]).get_indexer(category_names)
+    category_codes = np.where(
+        positions >= 0, catalog["Stimulus Code"].values[positions], -1
+    )
+    # Missing file names have category code -1, i.e. the appended -1
+    return np.append(category_codes, -1)[file_names.codes]
+
+
+def join_catalog(data, catalog, column="File Name"):
+    """ Adds each trial's stimulus code, and the catalog columns the
+    trials don't have yet.
+
+    :type data: pandas.DataFrame
+    :param data: Trials
+
+    :type catalog: pandas.DataFrame
+    :param catalog: Catalog, as returned by build_catalog
+
+    :type column: string
+    :param column: Column with the stimulus paths
+
+    :raises: ValueError if a stimulus isn't in the catalog
+
+    :rtype: pandas.DataFrame
+    """
+    codes = stimulus_codes(data[column], catalog)
+    if (codes < 0).any():
+        missing = data.loc[codes < 0, column].unique()
+        raise ValueError(f"Stimuli not in the catalog: {list(missing)}")
+    rows = catalog.set_index("Stimulus Code").loc[codes]
+    data = data.assign(**{"Stimulus Code": codes})
+    for name in catalog_columns[1:]:
+        if name not in data:
+            data[name] = rows[name].values
+    return data
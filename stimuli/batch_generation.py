@@ -0,0 +1,236 @@
+# Parallel generation of stimulus batches.
+#
+# Fans the (switch probability, exemplar) grid out to a pool of
+# worker processes. Sequences are drawn up front from a single
+# recorded seed (see switch_sequences.py), so the output is the
+# same for any number of workers. Each worker gets its share of the
+# grid as one batch, so the source audio is sent to it only once.
+
+from concurrent.futures import ProcessPoolExecutor
+from song_assembly import SongAssembler
+from stimulus_cache import segment_hash, stimulus_key
+from stimulus_export import export_song, manifest_entry, output_formats, update_manifest
+import os
+
+
+def song_file_name(path_prefix, switch_probability, chunk_size, exemplar, extension="mp3"):
+    """ Builds the file name of a generated song.
+
+    :type path_prefix: string
+    :param path_prefix: Directory (with trailing slash) to save into
+
+    :type switch_probability: float
+    :param switch_probability: Probability of switching tones per chunk
+
+    :type chunk_size: int
+    :param chunk_size: Duration of each tone in ms
+
+    :type exemplar: int
+    :param exemplar: Exemplar index
+
+    :type extension: string
+    :param extension: File extension (i.e., the output format)
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    return f"{path_prefix}switch-{str(round(switch_probability,2))}_chunk-{str(chunk_size)}_C_G_alternating_{str(exemplar).zfill(2)}.{extension}"
+
+
+def make_tasks(sequences):
+    """ Lists every cell of the (switch probability, exemplar) grid
+    along with its tone sequence.
+
+    :type sequences: SwitchSequences
+    :param sequences: Sequences of the whole grid
+
+    :raises: N/A
+
+    :rtype: list
+    """
+    return [
+        {
+            "switch_probability": switch_probability,
+            "exemplar": exemplar,
+            "sequence": sequences.sequence(rate_index, exemplar).tolist(),
+        }
+        for rate_index, switch_probability, exemplar in sequences.cells()
+    ]
+
+
+def render_tasks(
+    tasks, songs, silence, chunk_size, crossfade_duration, output_format, bitrate
+):
+    """ Assembles and exports the songs for a batch of cells, building
+    the assembler once for the whole batch.
+
+    :type tasks: list
+    :param tasks: Cells from make_tasks, with their song_name filled in
+
+    :type songs: list
+    :param songs: AudioSegments for each tone
+
+    :type silence: pydub.AudioSegment
+    :param silence: Silence inserted between tones
+
+    :type chunk_size: int
+    :param chunk_size: Duration of each tone in ms
+
+    :type crossfade_duration: int
+    :param crossfade_duration: Crossfade between segments in ms
+
+    :type output_format: string
+    :param output_format: One of stimulus_export.output_formats
+
+    :type bitrate: string
+    :param bitrate: MP3 bitrate
+
+    :raises: N/A
+
+    :rtype: void
+    """
+    assembler = SongAssembler(songs, silence, chunk_size, crossfade_duration)
+    for task in tasks:
+        song = assembler.assemble(task["sequence"])
+        export_song(song, task["song_name"], output_format, bitrate)
+
+
+def generate_batch(
+    songs,
+    silence,
+    path_prefix,
+    sequences,
+    chunk_size,
+    crossfade_duration,
+    num_workers=None,
+    output_format="mp3",
+    bitrate="192k",
+    cache=None,
+):
+    """ Generates every (switch probability, exemplar) song across a
+    pool of worker processes, and records them in the directory's
+    manifest. Results are returned in grid order and don't depend
+    on `num_workers`.
+
+    With a cache, songs whose inputs haven't changed are skipped, and
+    songs rendered before are copied from the cache; only the rest
+    are rendered.
+
+    On Windows, call this from a notebook or from under an
+    `if __name__ == "__main__":` guard, since workers re-import
+    the main script.
+
+    :type songs: list
+    :param songs: AudioSegments for each tone
+
+    :type silence: pydub.AudioSegment
+    :param silence: Silence inserted between tones
+
+    :type path_prefix: string
+    :param path_prefix: Directory (with trailing slash) to save into
+
+    :type sequences: SwitchSequences
+    :param sequences: Sequences of the whole grid
+
+    :type chunk_size: int
+    :param chunk_size: Duration of each tone in ms
+
+    :type crossfade_duration: int
+    :param crossfade_duration: Crossfade between segments in ms
+
+    :type num_workers: int
+    :param num_workers: Number of processes (default: one per core)
+
+    :type output_format: string
+    :param output_format: One of stimulus_export.output_formats
+
+    :type bitrate: string
+    :param bitrate: MP3 bitrate
+
+    :type cache: StimulusCache
+    :param cache: Cache of previously generated songs (default: none)
+
+    :raises: ValueError if the format is unknown
+
+    :rtype: list
+    """
+    if output_format not in output_formats:
+        raise ValueError(f"Unknown output format: {output_format}")
+    export_params = {"format": output_format, "bitrate": bitrate}
+    song_format = SongAssembler(songs, silence, chunk_size, crossfade_duration).template
+
+    tasks = make_tasks(sequences)
+    for task in tasks:
+        task["song_name"] = song_file_name(
+            path_prefix,
+            task["switch_probability"],
+            chunk_size,
+            task["exemplar"],
+            output_format,
+        )
+        task["status"] = "rendered"
+
+    pending = tasks
+    if cache is not None:
+        source_hashes = [segment_hash(song) for song in songs]
+        pending = []
+        for task in tasks:
+            task["key"] = stimulus_key(
+                source_hashes,
+                chunk_size,
+                crossfade_duration,
+                silence,
+                export_params,
+                task["sequence"],
+            )
+            if cache.is_current(task["song_name"], task["key"]):
+                task["status"] = "skipped"
+            elif cache.restore(task["key"], task["song_name"], output_format):
+                task["status"] = "restored"
+            else:
+                pending.append(task)
+
+    if pending:
+        # One batch per worker, striding over the grid to even out the load
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_batches = min(num_workers, len(pending))
+        batches = [pending[i::num_batches] for i in range(num_batches)]
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(
+                    render_tasks,
+                    batch,
+                    songs,
+                    silence,
+                    chunk_size,
+                    crossfade_duration,
+                    output_format,
+                    bitrate,
+                )
+                for batch in batches
+            ]
+            for batch, future in zip(batches, futures):
+                future.result()
+                if cache is not None:
+                    for task in batch:
+                        cache.store(task["key"], task["song_name"], output_format)
+
+    if cache is not None:
+        cache.save_index()
+
+    update_manifest(
+        path_prefix,
+        {
+            os.path.basename(task["song_name"]): manifest_entry(
+                song_format,
+                output_format,
+                switch_probability=task["switch_probability"],
+                exemplar=task["exemplar"],
+                sequence="".join(str(tone) for tone in task["sequence"]),
+            )
+            for task in tasks
+        },
+    )
+    return tasks
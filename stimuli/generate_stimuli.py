@@ -36,52 +36,66 @@
 
 # %%
 from pydub import AudioSegment
-from pydub.generators import Sine
 from pydub.playback import play
-import random
 import numpy as np
 import os
+from batch_generation import generate_batch
+from switch_sequences import SwitchSequences
+from stimulus_cache import StimulusCache
+from tone_synthesis import pure_tone
+import sys
+
+sys.path.append("../code")
+from audio_decoding import load_segment
 
 # %% [markdown]
 # # Functions
 
 # %%
-def generate_songs(path_prefix):
-    for switch_probability in switch_probabilities:
-        for exemplar in range(num_exemplars):
-            # Begin with silence
-            this_song = silence
-            # Choose random tone to start with
-            which_tone = round(random.random())
-            for chunk in range(num_chunks):
-                this_probability = random.random()
-
-                # Change tones if necessary
-                if this_probability < switch_probability:
-                    which_tone = 1 - which_tone
-
-                this_segment = songs[which_tone][:chunk_size]
-
-                # Add intervening silence
-                this_song = this_song.append(silence, crossfade=crossfade_duration)
-                # Add tone
-                this_song = this_song.append(this_segment, crossfade=crossfade_duration)
-
-            # Add final silence
-            this_song.append(silence, crossfade=crossfade_duration)
-            song_name = f"{path_prefix}switch-{str(round(switch_probability,2))}_chunk-{str(chunk_size)}_C_G_alternating_{str(exemplar).zfill(2)}.mp3"
-            this_song.export(song_name, format="mp3", bitrate="192k")
+def generate_songs(path_prefix, seed, output_format="mp3", sampling=None):
+    # Draw the whole grid from one seed, recorded next to the songs
+    sequences = SwitchSequences(
+        switch_probabilities, num_exemplars, num_chunks, seed=seed, sampling=sampling
+    )
+    sequences.save(f"{path_prefix}sequences.json")
+
+    # Unchanged songs are skipped and earlier renders copied from the
+    # cache; the rest are rendered across all cores
+    return generate_batch(
+        songs,
+        silence,
+        path_prefix=path_prefix,
+        sequences=sequences,
+        chunk_size=chunk_size,
+        crossfade_duration=crossfade_duration,
+        output_format=output_format,
+        cache=stimulus_cache,
+    )
 
 # %% [markdown]
 # # Stimulus Generation
+# Songs are written as `output_format`: `"mp3"` (192k), or losslessly as `"wav"`, `"flac"` or raw int16 `"npy"`, which skip the MP3 encode here and the decode in the experiment. Each directory's `manifest.json` records the format of every song in it.
+#
+# Each directory's sequences are drawn from a fixed seed and saved to its `sequences.json`, so the songs are the same no matter how many workers render them and any of them can be regenerated later.
+#
+# By default every chunk switches independently with the switch probability, so a song's realized switch rate varies around it. Pass `sampling` to draw songs whose switch counts match their switch probability instead, e.g. `sampling={"method": "permutation"}` (exact counts) or `{"method": "rejection", "tolerance": 1}` (within one switch); see `sample_switches` in `switch_sequences.py` for the options. The sampling settings are saved in `sequences.json` with the seed.
+#
+# Songs whose source audio, parameters and sequence are unchanged since the last run are skipped, and songs already rendered for an earlier parameter setting are copied from `stimulus_cache`; only new cells are rendered.
+
+# %%
+output_format = "mp3"
+sampling = None  # independent switch draws
 
 # %% [markdown]
 # ## Guitar chords
 
 # %%
+# Decoded chords are reused across runs
+stimulus_cache = StimulusCache(".stimulus_cache")
+
 songs = [
-    AudioSegment.from_mp3("guitar_chords/guitar_C.mp3"),
-    AudioSegment.from_mp3("guitar_chords/guitar_G.mp3"),
+    stimulus_cache.load_audio("guitar_chords/guitar_C.mp3", load=load_segment),
+    stimulus_cache.load_audio("guitar_chords/guitar_G.mp3", load=load_segment),
 ]
 
 chunk_size = 500 # in ms
@@ -92,7 +106,7 @@ switch_probabilities = np.linspace(0.1, 0.9, num=9)
 num_exemplars = 10
 silence = AudioSegment.silent(duration=silence_duration)
 # Generate the songs
-generate_songs(path_prefix="guitar_chords/")
+generate_songs(path_prefix="guitar_chords/", seed=20181220, output_format=output_format, sampling=sampling)
 
 # %% [markdown]
 # ## Tones
@@ -112,14 +126,12 @@ switch_probabilities = np.linspace(0.1, 0.9, num=9)
 num_exemplars = 10
 silence = AudioSegment.silent(duration=silence_duration)
 
-sine_waves = []
 songs = []
-for i, frequency in enumerate(frequencies):
-    sine_waves.append(Sine(frequency, sample_rate=sample_rate, bit_depth=bit_depth))
-    #Convert waveform to audio_segment for playback and export
-    songs.append(sine_waves[i].to_audio_segment(duration=chunk_size*2)) # just to make sure it's long enough
+for frequency in frequencies:
+    # Same samples as pydub's Sine generator, synthesized with NumPy
+    songs.append(pure_tone(frequency, duration=chunk_size*2, sample_rate=sample_rate, bit_depth=bit_depth)) # just to make sure it's long enough
 
-generate_songs(path_prefix="pure_tones/")
+generate_songs(path_prefix="pure_tones/", seed=20181221, output_format=output_format, sampling=sampling)
 
 # %% [markdown]
 # # Practice Stimulus
@@ -0,0 +1,361 @@
+# Bit-packed tone sequences.
+#
+# A sequence of 2 to 32 binary tones (0 for C, 1 for G) fits in one
+# uint32, with chunk i in bit i. Statistics of whole arrays of packed
+# sequences are a few bitwise operations and popcounts each: switch
+# counts are popcount(x ^ (x >> 1)) over the sequence's transitions,
+# so every one of the 2^20 possible 20-chunk sequences can be scored
+# at once.
+
+import numpy as np
+import pandas as pd
+
+max_chunks = 32
+
+
+def check_num_chunks(num_chunks):
+    """ Checks that sequences of num_chunks chunks can be packed and
+    have at least one transition between chunks.
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: ValueError unless 1 < num_chunks <= max_chunks
+
+    :rtype: void
+    """
+    if not 1 < num_chunks <= max_chunks:
+        raise ValueError(
+            f"Sequences need between 2 and {max_chunks} chunks, not {num_chunks}"
+        )
+
+
+def chunk_mask(num_bits):
+    """ uint32 with the lowest num_bits bits set.
+
+    :type num_bits: int
+    :param num_bits: Number of bits
+
+    :raises: N/A
+
+    :rtype: numpy.uint32
+    """
+    return np.uint32((1 << num_bits) - 1)
+
+
+def pack(tones):
+    """ Packs tone sequences (chunks on the last axis) into uint32s.
+
+    :type tones: numpy.ndarray
+    :param tones: Tones (0 or 1), e.g. SwitchSequences.tones
+
+    :raises: ValueError unless sequences have 2 to max_chunks chunks
+
+    :rtype: numpy.ndarray
+    """
+    tones = np.asarray(tones)
+    check_num_chunks(tones.shape[-1])
+    weights = np.left_shift(np.uint32(1), np.arange(tones.shape[-1], dtype=np.uint32))
+    return (tones.astype(np.uint32) * weights).sum(axis=-1, dtype=np.uint32)
+
+
+def unpack(packed, num_chunks):
+    """ Tone sequences of packed sequences, with chunks on a new
+    last axis.
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    shifts = np.arange(num_chunks, dtype=np.uint32)
+    packed = np.asarray(packed, dtype=np.uint32)[..., np.newaxis]
+    return ((packed >> shifts) & np.uint32(1)).astype(np.uint8)
+
+
+def pack_strings(sequences):
+    """ Packs sequences written as strings of 0s and 1s (as in
+    SwitchSequences.save). All strings must have the same length.
+
+    :type sequences: list
+    :param sequences: Sequences (e.g., ["0011", "0110"])
+
+    :raises: ValueError if the strings differ in length or don't have
+        2 to max_chunks chunks
+
+    :rtype: numpy.ndarray
+    """
+    sequences = list(sequences)
+    if not sequences:
+        return np.zeros(0, dtype=np.uint32)
+    num_chunks = len(sequences[0])
+    if any(len(sequence) != num_chunks for sequence in sequences):
+        raise ValueError("Sequences differ in length")
+    characters = np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8)
+    return pack((characters - ord("0")).reshape(len(sequences), num_chunks))
+
+
+def popcount(packed):
+    """ Number of set bits of each uint32.
+
+    :type packed: numpy.ndarray
+    :param packed: uint32s
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    x = np.asarray(packed, dtype=np.uint32)
+    x = x - ((x >> np.uint32(1)) & np.uint32(0x55555555))
+    x = (x & np.uint32(0x33333333)) + ((x >> np.uint32(2)) & np.uint32(0x33333333))
+    x = (x + (x >> np.uint32(4))) & np.uint32(0x0F0F0F0F)
+    return ((x * np.uint32(0x01010101)) >> np.uint32(24)).astype(np.int64)
+
+
+def reverse(packed, num_chunks):
+    """ Packed sequences played backwards.
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    x = np.asarray(packed, dtype=np.uint32)
+    for shift, mask in [
+        (1, 0x55555555),
+        (2, 0x33333333),
+        (4, 0x0F0F0F0F),
+        (8, 0x00FF00FF),
+    ]:
+        shift, mask = np.uint32(shift), np.uint32(mask)
+        x = ((x >> shift) & mask) | ((x & mask) << shift)
+    x = (x >> np.uint32(16)) | (x << np.uint32(16))
+    return x >> np.uint32(max_chunks - num_chunks)
+
+
+def target_switches(switch_probability, num_chunks):
+    """ Number of switches a switch probability leads to on average,
+    rounded to the nearest switch (halves round up).
+
+    :type switch_probability: float or numpy.ndarray
+    :param switch_probability: Switch probability (or probabilities)
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: int or numpy.ndarray
+    """
+    return np.floor(np.asarray(switch_probability) * (num_chunks - 1) + 0.5).astype(
+        np.int64
+    )
+
+
+def switch_counts(packed, num_chunks):
+    """ Number of times each sequence switches tones.
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    x = np.asarray(packed, dtype=np.uint32)
+    return popcount((x ^ (x >> np.uint32(1))) & chunk_mask(num_chunks - 1))
+
+
+def longest_runs(packed, num_chunks):
+    """ Length of the longest run of one tone in each sequence.
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    x = np.asarray(packed, dtype=np.uint32)
+    # Bit i is set where chunk i + 1 repeats chunk i; each pass of
+    # y & (y >> 1) shortens every run of set bits by one
+    y = ~(x ^ (x >> np.uint32(1))) & chunk_mask(num_chunks - 1)
+    runs = np.ones(x.shape, dtype=np.int64)
+    while y.any():
+        runs += y != 0
+        y &= y >> np.uint32(1)
+    return runs
+
+
+def balances(packed, num_chunks):
+    """ Number of G chunks minus number of C chunks of each sequence.
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    return 2 * popcount(packed) - num_chunks
+
+
+def symmetries(packed, num_chunks):
+    """ Share of chunks that match their mirror-image chunk (1 for
+    palindromes).
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    x = np.asarray(packed, dtype=np.uint32)
+    matches = ~(x ^ reverse(x, num_chunks)) & chunk_mask(num_chunks)
+    return popcount(matches) / num_chunks
+
+
+class SequenceStore:
+    """ An array of bit-packed sequences of the same length, with
+    vectorized statistics.
+    """
+
+    def __init__(self, packed, num_chunks):
+        """
+        :type packed: numpy.ndarray
+        :param packed: Packed sequences
+
+        :type num_chunks: int
+        :param num_chunks: Number of chunks per sequence
+
+        :raises: ValueError unless 1 < num_chunks <= max_chunks
+        """
+        check_num_chunks(num_chunks)
+        self.packed = np.asarray(packed, dtype=np.uint32)
+        self.num_chunks = num_chunks
+
+    @classmethod
+    def from_tones(cls, tones):
+        """ Packs tone sequences (chunks on the last axis).
+
+        :type tones: numpy.ndarray
+        :param tones: Tones (0 or 1), e.g. SwitchSequences.tones
+
+        :raises: ValueError unless sequences have 2 to max_chunks chunks
+
+        :rtype: SequenceStore
+        """
+        tones = np.asarray(tones)
+        return cls(pack(tones), tones.shape[-1])
+
+    @classmethod
+    def from_strings(cls, sequences):
+        """ Packs sequences written as strings of 0s and 1s.
+
+        :type sequences: list
+        :param sequences: Sequences (e.g., the "Sequence" column of
+            sequence_detection's output)
+
+        :raises: ValueError if the strings differ in length or don't
+            have 2 to max_chunks chunks
+
+        :rtype: SequenceStore
+        """
+        sequences = list(sequences)
+        num_chunks = len(sequences[0]) if sequences else 0
+        return cls(pack_strings(sequences), num_chunks)
+
+    @classmethod
+    def every_sequence(cls, num_chunks):
+        """ All 2^num_chunks sequences, in order of their packed value.
+
+        :type num_chunks: int
+        :param num_chunks: Number of chunks per sequence
+
+        :raises: ValueError unless 1 < num_chunks <= max_chunks
+
+        :rtype: SequenceStore
+        """
+        check_num_chunks(num_chunks)
+        return cls(np.arange(1 << num_chunks, dtype=np.uint32), num_chunks)
+
+    def __len__(self):
+        return self.packed.size
+
+    def tones(self):
+        """ Unpacked tone sequences.
+
+        :raises: N/A
+
+        :rtype: numpy.ndarray
+        """
+        return unpack(self.packed, self.num_chunks)
+
+    def switch_rates(self):
+        """ Realized switch rate of each sequence: switches per
+        transition between chunks.
+
+        :raises: N/A
+
+        :rtype: numpy.ndarray
+        """
+        return switch_counts(self.packed, self.num_chunks) / (self.num_chunks - 1)
+
+    def matching_rate(self, switch_probability, tolerance=0):
+        """ Whether each sequence's switch count is within tolerance of
+        the count a switch probability leads to on average (rounded to
+        the nearest switch).
+
+        :type switch_probability: float
+        :param switch_probability: Nominal switch probability
+
+        :type tolerance: int
+        :param tolerance: Allowed difference in switches
+
+        :raises: N/A
+
+        :rtype: numpy.ndarray
+        """
+        expected = target_switches(switch_probability, self.num_chunks)
+        counts = switch_counts(self.packed, self.num_chunks)
+        return np.abs(counts - expected) <= tolerance
+
+    def statistics(self):
+        """ Statistics of every sequence, one row per sequence.
+
+        :raises: N/A
+
+        :rtype: pandas.DataFrame
+        """
+        return pd.DataFrame(
+            {
+                "Packed": self.packed.ravel(),
+                "Switches": switch_counts(self.packed, self.num_chunks).ravel(),
+                "Longest Run": longest_runs(self.packed, self.num_chunks).ravel(),
+                "Balance": balances(self.packed, self.num_chunks).ravel(),
+                "Symmetry": symmetries(self.packed, self.num_chunks).ravel(),
+            }
+        )
@@ -0,0 +1,326 @@
+# Recovers tone sequences from rendered stimuli.
+#
+# The stimuli in combined/ were generated before sequences were
+# drawn from a recorded seed (see switch_sequences.py), so the only
+# record of which tone each chunk played is the audio itself. Each
+# stimulus is decoded once and cut into its chunks (skipping the
+# crossfades); pure-tone chunks are classified by their power at the
+# C4 and G4 frequencies, computed for every chunk at once, and
+# guitar chunks by their spectral match to the C and G chord
+# recordings. Batches of stimuli are decoded and scored in parallel.
+#
+# Usage: python sequence_detection.py stimulus_dir [output_file]
+
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code")
+sys.path.append(code_dir)
+from audio_decoding import decode, decode_many
+
+tone_frequencies = [261.626, 391.995]  # C4, G4, as in generate_stimuli
+chord_file_names = ["guitar_chords/guitar_C.mp3", "guitar_chords/guitar_G.mp3"]
+chunk_size = 500  # in ms
+silence_duration = 100  # in ms
+crossfade_duration = 50  # in ms
+batch_size = 16  # stimuli decoded and scored per task
+
+# A chunk whose stronger tone frequency holds at least this share of
+# its energy is a pure tone (a pure tone holds all of it)
+purity_threshold = 0.5
+
+# Templates are compared below this frequency, where the chords'
+# partials are
+max_template_frequency = 4000  # in Hz
+
+
+def to_mono(frames):
+    """ Mono samples in [-1, 1] of 16-bit frames.
+
+    :type frames: numpy.ndarray
+    :param frames: Array of shape (num_frames, channels)
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    return frames.mean(axis=1, dtype=np.float32) / np.float32(1 << 15)
+
+
+def window_bounds(frame_rate):
+    """ First frame of the first chunk's analysis window, the window
+    length, and the frames between chunks. Windows leave out the
+    crossfades at both ends of each chunk.
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :raises: N/A
+
+    :rtype: tuple
+    """
+    start = int(frame_rate * (silence_duration + crossfade_duration) / 1000.0)
+    length = int(frame_rate * (chunk_size - 2 * crossfade_duration) / 1000.0)
+    step = int(frame_rate * chunk_size / 1000.0)
+    return start, length, step
+
+
+def chunk_windows(samples, frame_rate, num_chunks):
+    """ Hann-windowed samples of each chunk of a stimulus.
+
+    :type samples: numpy.ndarray
+    :param samples: Mono samples
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks
+
+    :raises: ValueError if the stimulus is too short
+
+    :rtype: numpy.ndarray
+    """
+    start, length, step = window_bounds(frame_rate)
+    if start + (num_chunks - 1) * step + length > len(samples):
+        raise ValueError(f"Stimulus is shorter than {num_chunks} chunks")
+    rows = start + step * np.arange(num_chunks)[:, np.newaxis]
+    return samples[rows + np.arange(length)] * np.hanning(length).astype(np.float32)
+
+
+def count_chunks(num_frames, frame_rate):
+    """ Number of chunks in a stimulus of the given length (the song
+    starts with silence and every chunk adds chunk_size ms).
+
+    :type num_frames: int
+    :param num_frames: Length of the stimulus in frames
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :raises: N/A
+
+    :rtype: int
+    """
+    length = 1000.0 * num_frames / frame_rate
+    return int(round((length - silence_duration) / chunk_size))
+
+
+def goertzel_power(windows, frequencies, frame_rate):
+    """ Power of each window at each frequency: the power the Goertzel
+    recurrence gives, computed for all windows at once as one matrix
+    product.
+
+    :type windows: numpy.ndarray
+    :param windows: Array of shape (num_windows, window_length)
+
+    :type frequencies: list
+    :param frequencies: Frequencies in Hz
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    phase = (
+        2
+        * np.pi
+        * np.arange(windows.shape[-1])[:, np.newaxis]
+        * np.asarray(frequencies)[np.newaxis, :]
+        / frame_rate
+    )
+    real = windows @ np.cos(phase).astype(np.float32)
+    imaginary = windows @ np.sin(phase).astype(np.float32)
+    return real.astype(np.float64) ** 2 + imaginary.astype(np.float64) ** 2
+
+
+def tone_purity(windows, power):
+    """ Share of each window's energy at its strongest frequency,
+    scaled so that a Hann-windowed pure tone scores 1.
+
+    :type windows: numpy.ndarray
+    :param windows: Hann-windowed samples, shape (num_windows, window_length)
+
+    :type power: numpy.ndarray
+    :param power: Power at each frequency, as returned by goertzel_power
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    energy = np.square(windows, dtype=np.float64).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        purity = 3 * power.max(axis=1) / (windows.shape[1] * energy)
+    return np.nan_to_num(purity)
+
+
+def spectra(windows, frame_rate):
+    """ Unit-length magnitude spectra of windows, up to
+    max_template_frequency.
+
+    :type windows: numpy.ndarray
+    :param windows: Hann-windowed samples, shape (num_windows, window_length)
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    num_bins = int(max_template_frequency * windows.shape[1] / frame_rate) + 1
+    magnitudes = np.abs(np.fft.rfft(windows, axis=1))[:, :num_bins]
+    norms = np.linalg.norm(magnitudes, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return magnitudes / norms
+
+
+def chord_templates(frames_list, frame_rate):
+    """ Spectra of the chords, taken from the part of each recording
+    that ends up in a chunk.
+
+    :type frames_list: list
+    :param frames_list: Frames of each chord recording (e.g., [C, G])
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    start, length, _ = window_bounds(frame_rate)
+    offset = start - int(frame_rate * silence_duration / 1000.0)
+    window = np.hanning(length).astype(np.float32)
+    windows = np.stack(
+        [to_mono(frames)[offset : offset + length] * window for frames in frames_list]
+    )
+    return spectra(windows, frame_rate)
+
+
+def detect_sequence(frames, frame_rate, templates):
+    """ Tone (0 for C, 1 for G) of every chunk of a stimulus, whether it
+    is made of pure tones or chords, and the smallest margin by which
+    a chunk was classified (0 to 1).
+
+    :type frames: numpy.ndarray
+    :param frames: Frames of the stimulus
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :type templates: numpy.ndarray
+    :param templates: Chord spectra, as returned by chord_templates
+
+    :raises: ValueError if the stimulus is too short
+
+    :rtype: tuple
+    """
+    num_chunks = count_chunks(len(frames), frame_rate)
+    windows = chunk_windows(to_mono(frames), frame_rate, num_chunks)
+    power = goertzel_power(windows, tone_frequencies, frame_rate)
+    if np.median(tone_purity(windows, power)) >= purity_threshold:
+        kind = "tone"
+        scores = power / power.sum(axis=1, keepdims=True)
+    else:
+        kind = "guitar"
+        scores = spectra(windows, frame_rate) @ templates.T
+    sequence = scores.argmax(axis=1).astype(np.uint8)
+    ordered = np.sort(scores, axis=1)
+    margin = float((ordered[:, -1] - ordered[:, -2]).min())
+    return sequence, kind, margin
+
+
+def detect_batch(file_names, templates, template_rate):
+    """ Decodes and detects the sequences of a batch of stimuli.
+
+    :type file_names: list
+    :param file_names: Paths of the stimuli
+
+    :type templates: numpy.ndarray
+    :param templates: Chord spectra, as returned by chord_templates
+
+    :type template_rate: int
+    :param template_rate: Frame rate of the chord recordings
+
+    :raises: ValueError if a stimulus' frame rate differs from the chords'
+
+    :rtype: list
+    """
+    rows = []
+    for file_name, (frames, frame_rate) in zip(
+        file_names, decode_many(file_names, num_workers=1)
+    ):
+        if frame_rate != template_rate:
+            raise ValueError(f"{file_name} isn't at {template_rate} Hz")
+        sequence, kind, margin = detect_sequence(frames, frame_rate, templates)
+        rows.append(
+            {
+                "Stimulus Name": os.path.basename(file_name),
+                "Detected Type": kind,
+                "Num Chunks": len(sequence),
+                "Sequence": "".join(str(tone) for tone in sequence),
+                "Margin": margin,
+            }
+        )
+    return rows
+
+
+def detect_stimuli(file_names, chord_dir=".", num_workers=None):
+    """ Recovers the tone sequence of every stimulus, one row per
+    stimulus. Sequences use the tone indices of generate_songs
+    (0 for C, 1 for G).
+
+    :type file_names: list
+    :param file_names: Paths of the stimuli
+
+    :type chord_dir: string
+    :param chord_dir: Directory containing chord_file_names
+
+    :type num_workers: int
+    :param num_workers: Number of threads (default: ThreadPoolExecutor's)
+
+    :raises: ValueError if a stimulus can't be cut into chunks
+
+    :rtype: pandas.DataFrame
+    """
+    decoded = [decode(os.path.join(chord_dir, f)) for f in chord_file_names]
+    template_rate = decoded[0][1]
+    templates = chord_templates([frames for frames, _ in decoded], template_rate)
+
+    file_names = list(file_names)
+    batches = [
+        file_names[i : i + batch_size] for i in range(0, len(file_names), batch_size)
+    ]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(
+            detect_batch,
+            batches,
+            [templates] * len(batches),
+            [template_rate] * len(batches),
+        )
+        rows = [row for batch in results for row in batch]
+    return pd.DataFrame(
+        rows,
+        columns=["Stimulus Name", "Detected Type", "Num Chunks", "Sequence", "Margin"],
+    )
+
+
+if __name__ == "__main__":
+    stimulus_dir = sys.argv[1] if len(sys.argv) > 1 else "combined/"
+    output_file_name = (
+        sys.argv[2]
+        if len(sys.argv) > 2
+        else os.path.join(stimulus_dir, "detected_sequences.tsv")
+    )
+    file_names = sorted(glob.glob(os.path.join(stimulus_dir, "switch-*.mp3")))
+    chord_dir = os.path.dirname(os.path.abspath(__file__))
+    sequences = detect_stimuli(file_names, chord_dir=chord_dir)
+    sequences.to_csv(output_file_name, sep="\t", index=False)
+    print(f"Detected sequences of {len(sequences)} stimuli in {output_file_name}")
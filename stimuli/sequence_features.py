@@ -0,0 +1,251 @@
+# Complexity features of tone sequences.
+#
+# Computes block entropies, Lempel-Ziv complexity, lag-k
+# autocorrelations and run-length histograms of many bit-packed
+# sequences (see sequence_bits.py) at once: every feature is a loop
+# over chunk positions (or parsing steps) with the sequences as
+# NumPy arrays, and each distinct sequence is only scored once.
+# Features are cached per stimulus in a tab-separated file keyed by
+# "Stimulus Name", the same key as paper/stimulus_catalog.py, so
+# they join onto the trials with a merge.
+
+from sequence_bits import SequenceStore, chunk_mask, popcount, unpack
+import numpy as np
+import os
+import pandas as pd
+
+# Block sizes longer than a sequence and lags as long as it have no
+# blocks or pairs, and score NaN
+block_sizes = [1, 2, 3]
+lags = [1, 2, 3]
+
+
+def block_entropies(packed, num_chunks, block_size):
+    """ Shannon entropy (in bits) of the overlapping blocks of
+    block_size chunks in each sequence (NaN if the sequences are
+    shorter than a block).
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :type block_size: int
+    :param block_size: Chunks per block
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    packed = np.asarray(packed, dtype=np.uint32).ravel()
+    num_blocks = num_chunks - block_size + 1
+    if num_blocks < 1:
+        return np.full(packed.size, np.nan)
+    rows = np.arange(packed.size)
+    counts = np.zeros((packed.size, 1 << block_size), dtype=np.int64)
+    for offset in range(num_blocks):
+        blocks = (packed >> np.uint32(offset)) & chunk_mask(block_size)
+        counts[rows, blocks] += 1
+    p = counts / num_blocks
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 0.0 - np.where(p > 0, p * np.log2(p), 0.0).sum(axis=1)
+
+
+def lempel_ziv_complexity(packed, num_chunks):
+    """ Lempel-Ziv (1976) complexity of each sequence: the number of
+    new patterns met reading it left to right, counted with the
+    Kaspar-Schuster algorithm run on all sequences in lockstep.
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    packed = np.asarray(packed, dtype=np.uint32).ravel()
+    complexity = np.ones(packed.size, dtype=np.int64)
+    if num_chunks < 2:
+        return complexity
+
+    # State of the sequences still being parsed. Finished sequences
+    # are dropped whenever they make up half the arrays, so later
+    # steps only touch the rest.
+    which = np.arange(packed.size)
+    x = packed
+    i = np.zeros(packed.size, dtype=np.int32)
+    k = np.ones(packed.size, dtype=np.int32)
+    l = np.ones(packed.size, dtype=np.int32)
+    k_max = np.ones(packed.size, dtype=np.int32)
+    c = np.ones(packed.size, dtype=np.int32)
+    done = np.zeros(packed.size, dtype=bool)
+    last = num_chunks - 1
+    while which.size:
+        first = (x >> np.minimum(i + k - 1, last).astype(np.uint32)) & np.uint32(1)
+        second = (x >> np.minimum(l + k - 1, last).astype(np.uint32)) & np.uint32(1)
+        same = (first == second) & ~done
+        different = (first != second) & ~done
+
+        k_next = k + 1
+        finished = same & (l + k_next > num_chunks)
+        k_max = np.where(different, np.maximum(k_max, k), k_max)
+        i = np.where(different, i + 1, i)
+        new_pattern = different & (i == l)
+        l = np.where(new_pattern, l + k_max, l)
+        finished |= new_pattern & (l + 1 > num_chunks)
+        c += finished & same
+        c += new_pattern
+        i = np.where(new_pattern, 0, i)
+        k_max = np.where(new_pattern, 1, k_max)
+        k = np.where(same, k_next, 1)
+        done |= finished
+
+        if 2 * done.sum() >= which.size:
+            complexity[which[done]] = c[done]
+            keep = ~done
+            which, x, i, k, l, k_max, c, done = (
+                a[keep] for a in (which, x, i, k, l, k_max, c, done)
+            )
+    return complexity
+
+
+def autocorrelations(packed, num_chunks, lag):
+    """ Lag-k autocorrelation of each sequence, with tones as -1 and
+    +1 (NaN for sequences of a single tone, and for lags of
+    num_chunks or more).
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :type lag: int
+    :param lag: Lag in chunks
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    x = np.asarray(packed, dtype=np.uint32).ravel()
+    num_pairs = num_chunks - lag
+    if num_pairs < 1:
+        return np.full(x.size, np.nan)
+    pair_mask = chunk_mask(num_pairs)
+    # Sums of +/-1 tones: products over pairs, and the first and last
+    # num_pairs tones
+    products = num_pairs - 2 * popcount((x ^ (x >> np.uint32(lag))) & pair_mask)
+    heads = 2 * popcount(x & pair_mask) - num_pairs
+    tails = 2 * popcount((x >> np.uint32(lag)) & pair_mask) - num_pairs
+    mean = (2 * popcount(x & chunk_mask(num_chunks)) - num_chunks) / num_chunks
+    covariance = products - mean * (heads + tails) + num_pairs * mean ** 2
+    variance = num_chunks * (1 - mean ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(variance > 0, covariance / variance, np.nan)
+
+
+def run_length_histograms(packed, num_chunks):
+    """ Number of runs of each length (1 to num_chunks) in each
+    sequence.
+
+    :type packed: numpy.ndarray
+    :param packed: Packed sequences
+
+    :type num_chunks: int
+    :param num_chunks: Number of chunks per sequence
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    tones = unpack(np.asarray(packed, dtype=np.uint32).ravel(), num_chunks)
+    ends = np.ones(tones.shape, dtype=bool)
+    ends[:, :-1] = tones[:, 1:] != tones[:, :-1]
+    rows, positions = np.nonzero(ends)
+    previous = np.empty_like(positions)
+    previous[0:1] = -1
+    previous[1:] = np.where(rows[1:] == rows[:-1], positions[:-1], -1)
+    lengths = positions - previous
+    histograms = np.bincount(
+        rows * (num_chunks + 1) + lengths, minlength=len(tones) * (num_chunks + 1)
+    )
+    return histograms.reshape(len(tones), num_chunks + 1)[:, 1:]
+
+
+def sequence_features(store):
+    """ Features of every sequence in a store, one row per sequence.
+    Each distinct sequence is only scored once.
+
+    :type store: sequence_bits.SequenceStore
+    :param store: Sequences
+
+    :raises: N/A
+
+    :rtype: pandas.DataFrame
+    """
+    n = store.num_chunks
+    distinct, which = np.unique(store.packed.ravel(), return_inverse=True)
+    columns = {"Packed": distinct}
+    for block_size in block_sizes:
+        entropies = block_entropies(distinct, n, block_size)
+        columns[f"Block Entropy {block_size}"] = entropies
+    columns["LZ Complexity"] = lempel_ziv_complexity(distinct, n)
+    for lag in lags:
+        columns[f"Autocorrelation {lag}"] = autocorrelations(distinct, n, lag)
+    histograms = run_length_histograms(distinct, n)
+    for length in range(1, n + 1):
+        columns[f"Runs of {length}"] = histograms[:, length - 1]
+    features = pd.DataFrame(columns)
+    return features.iloc[which.ravel()].reset_index(drop=True)
+
+
+def stimulus_features(sequences, cache_file_name=None):
+    """ Features of each stimulus's sequence, reusing those cached for
+    stimuli whose sequence hasn't changed.
+
+    :type sequences: pandas.DataFrame
+    :param sequences: "Stimulus Name" and "Sequence" (a string of 0s
+        and 1s) of each stimulus, e.g. sequence_detection's output
+
+    :type cache_file_name: string
+    :param cache_file_name: Tab-separated file to cache features in
+
+    :raises: ValueError if the sequences differ in length
+
+    :rtype: pandas.DataFrame
+    """
+    sequences = sequences[["Stimulus Name", "Sequence"]]
+    cached = None
+    if cache_file_name is not None and os.path.exists(cache_file_name):
+        cached = pd.read_csv(
+            cache_file_name,
+            sep="\t",
+            dtype={"Sequence": str},
+            float_precision="round_trip",
+        )
+        cached = cached.merge(sequences, on=["Stimulus Name", "Sequence"])
+        new = sequences[~sequences["Stimulus Name"].isin(cached["Stimulus Name"])]
+    else:
+        new = sequences
+
+    if len(new):
+        features = sequence_features(SequenceStore.from_strings(new["Sequence"]))
+        features = pd.concat(
+            [new.reset_index(drop=True), features.drop(columns="Packed")], axis=1
+        )
+    else:
+        features = None
+    features = pd.concat(
+        [f for f in [cached, features] if f is not None], ignore_index=True, sort=False
+    )
+    features = sequences.merge(features, on=["Stimulus Name", "Sequence"], how="left")
+
+    if cache_file_name is not None and len(new):
+        temp_file_name = f"{cache_file_name}.tmp"
+        features.to_csv(temp_file_name, sep="\t", index=False)
+        os.replace(temp_file_name, cache_file_name)
+    return features
@@ -0,0 +1,435 @@
+# Linear-time assembly of switch sequences into songs.
+#
+# `generate_songs` used to build each song with a chain of
+# `AudioSegment.append(..., crossfade=...)` calls, each of which
+# copies the whole song so far. The SongAssembler below reproduces
+# that chain sample for sample, but precomputes the crossfaded
+# tone/silence frames once and writes every sequence into a single
+# preallocated NumPy buffer.
+
+from pydub import AudioSegment
+from pydub.utils import db_to_float
+import numpy as np
+
+# pydub fades crossfades from/to -120 dB
+crossfade_gain = -120
+
+# audioop sample widths (in bytes) and their NumPy equivalents
+sample_dtypes = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def frame_count(frame_rate, ms):
+    """ Number of frames in the given number of milliseconds,
+    computed exactly as pydub's AudioSegment.frame_count does.
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :type ms: float
+    :param ms: Duration in milliseconds
+
+    :raises: N/A
+
+    :rtype: float
+    """
+    return ms * (frame_rate / 1000.0)
+
+
+def length_ms(num_frames, frame_rate):
+    """ Length of a segment with the given number of frames,
+    in milliseconds (i.e., len(AudioSegment)).
+
+    :type num_frames: int
+    :param num_frames: Number of frames in the segment
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :raises: N/A
+
+    :rtype: int
+    """
+    return round(1000 * (float(num_frames) / frame_rate))
+
+
+def parse_position(num_frames, frame_rate, ms):
+    """ Converts a (possibly negative) millisecond position into
+    a frame index, as AudioSegment slicing does.
+
+    :type num_frames: int
+    :param num_frames: Number of frames in the segment being sliced
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :type ms: float
+    :param ms: Position in milliseconds
+
+    :raises: N/A
+
+    :rtype: int
+    """
+    length = length_ms(num_frames, frame_rate)
+    if ms < 0:
+        ms = length - abs(ms)
+    if ms == float("inf"):
+        ms = length
+    return int(frame_count(frame_rate, ms))
+
+
+def slice_frames(frames, frame_rate, start=None, end=None):
+    """ Slices an array of frames by milliseconds, padding
+    with silence (or truncating) exactly as AudioSegment.__getitem__.
+
+    :type frames: numpy.ndarray
+    :param frames: Array of shape (num_frames, channels)
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :type start: float
+    :param start: Start of the slice in ms (default: beginning)
+
+    :type end: float
+    :param end: End of the slice in ms (default: end of segment)
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    num_frames = len(frames)
+    length = length_ms(num_frames, frame_rate)
+    start = min(0 if start is None else start, length)
+    end = min(length if end is None else end, length)
+    start_frame = parse_position(num_frames, frame_rate, start)
+    end_frame = parse_position(num_frames, frame_rate, end)
+    sliced = frames[start_frame:end_frame]
+    missing_frames = (end_frame - start_frame) - len(sliced)
+    if missing_frames > 0:
+        padding = np.zeros((missing_frames, frames.shape[1]), dtype=frames.dtype)
+        sliced = np.concatenate([sliced, padding])
+    return sliced
+
+
+def multiply(frames, gains):
+    """ Scales frames by per-frame gains, rounding towards minus
+    infinity and saturating like audioop.mul.
+
+    :type frames: numpy.ndarray
+    :param frames: Array of shape (num_frames, channels)
+
+    :type gains: numpy.ndarray or float
+    :param gains: Gain for each frame (or a single gain)
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    info = np.iinfo(frames.dtype)
+    gains = np.asarray(gains, dtype=np.float64)
+    if gains.ndim == 1:
+        gains = gains[:, np.newaxis]
+    scaled = np.floor(frames * gains)
+    return np.clip(scaled, info.min, info.max).astype(frames.dtype)
+
+
+def add(frames_1, frames_2):
+    """ Adds two equally long arrays of frames, saturating
+    like audioop.add.
+
+    :type frames_1: numpy.ndarray
+    :param frames_1: Array of shape (num_frames, channels)
+
+    :type frames_2: numpy.ndarray
+    :param frames_2: Array of shape (num_frames, channels)
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    info = np.iinfo(frames_1.dtype)
+    summed = frames_1.astype(np.int64) + frames_2
+    return np.clip(summed, info.min, info.max).astype(frames_1.dtype)
+
+
+def fade_gains(length, frame_rate, from_gain=0, to_gain=0):
+    """ Per-frame gains of AudioSegment.fade applied across
+    the whole of a segment that is `length` ms long.
+
+    Fades of at most 100 ms change gain on every frame;
+    longer fades change gain once per millisecond.
+
+    :type length: int
+    :param length: Length of the faded segment in ms
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :type from_gain: float
+    :param from_gain: Starting gain in dB
+
+    :type to_gain: float
+    :param to_gain: Final gain in dB
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    from_power = db_to_float(from_gain)
+    gain_delta = db_to_float(to_gain) - from_power
+    if length > 100:
+        scale_step = gain_delta / length
+        steps = from_power + (scale_step * np.arange(length))
+        frames_per_step = [
+            int(frame_count(frame_rate, i + 1)) - int(frame_count(frame_rate, i))
+            for i in range(length)
+        ]
+        return np.repeat(steps, frames_per_step)
+    else:
+        fade_frames = frame_count(frame_rate, length)
+        if fade_frames == 0:
+            return np.zeros(0)
+        scale_step = gain_delta / fade_frames
+        return from_power + (scale_step * np.arange(int(fade_frames)))
+
+
+def fade(frames, frame_rate, from_gain=0, to_gain=0):
+    """ Fades an array of frames across its whole length,
+    as AudioSegment.fade(start=0, end=float("inf")) does.
+
+    :type frames: numpy.ndarray
+    :param frames: Array of shape (num_frames, channels)
+
+    :type frame_rate: int
+    :param frame_rate: Frame rate in Hz
+
+    :type from_gain: float
+    :param from_gain: Starting gain in dB
+
+    :type to_gain: float
+    :param to_gain: Final gain in dB
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    length = length_ms(len(frames), frame_rate)
+    gains = fade_gains(length, frame_rate, from_gain, to_gain)
+    if length > 100:
+        # Coarse fades read whole milliseconds, padding with silence
+        frames = slice_frames(frames, frame_rate, 0, length)
+    else:
+        # Precise fades read single frames, dropping any beyond the end
+        gains = gains[: len(frames)]
+    return multiply(frames[: len(gains)], gains)
+
+
+def overlay_looped(frames_1, frames_2):
+    """ Overlays frames_2 onto frames_1, looping it to the
+    length of frames_1 (i.e., `frames_1 * frames_2` in pydub).
+
+    :type frames_1: numpy.ndarray
+    :param frames_1: Array of shape (num_frames, channels)
+
+    :type frames_2: numpy.ndarray
+    :param frames_2: Array of shape (num_frames, channels)
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    num_repeats = -(-len(frames_1) // len(frames_2))
+    looped = np.tile(frames_2, (num_repeats, 1))[: len(frames_1)]
+    return add(frames_1, looped)
+
+
+def to_frames(segment):
+    """ Views the raw data of an AudioSegment as an array
+    of shape (num_frames, channels).
+
+    :type segment: pydub.AudioSegment
+    :param segment: Audio segment to convert
+
+    :raises: ValueError if the sample width is unsupported
+
+    :rtype: numpy.ndarray
+    """
+    if segment.sample_width not in sample_dtypes:
+        raise ValueError(f"Unsupported sample width: {segment.sample_width}")
+    dtype = sample_dtypes[segment.sample_width]
+    samples = np.frombuffer(segment.raw_data, dtype=dtype)
+    return samples.reshape(-1, segment.channels)
+
+
+class SongAssembler:
+    """ Assembles sequences of tones into songs in time linear
+    in the number of chunks.
+
+    Every sequence produces the same samples as the original
+    `generate_songs` loop: start with silence, then for each chunk
+    append silence and the chosen tone (cut to `chunk_size` ms) with
+    a `crossfade_duration` ms crossfade. As in that loop, no final
+    silence is appended.
+
+    Tones are converted to a common format up front, so output is
+    sample-identical to the append chain whenever the tones already
+    share a format (as the guitar chords and the pure tones do). With
+    no crossfade, segments are simply concatenated, as append does.
+    """
+
+    def __init__(self, songs, silence, chunk_size, crossfade_duration):
+        """
+        :type songs: list
+        :param songs: AudioSegments for each tone (e.g., [C, G])
+
+        :type silence: pydub.AudioSegment
+        :param silence: Silence inserted between tones
+
+        :type chunk_size: int
+        :param chunk_size: Duration of each tone in ms
+
+        :type crossfade_duration: int
+        :param crossfade_duration: Crossfade between segments in ms
+
+        :raises: ValueError if a segment is shorter than the crossfade
+        """
+        self.silence = silence
+        self.chunk_size = chunk_size
+        self.crossfade_duration = crossfade_duration
+
+        segments = AudioSegment._sync(*[song[:chunk_size] for song in songs], silence)
+        for segment in segments:
+            if crossfade_duration > len(segment):
+                raise ValueError(
+                    f"Crossfade is longer than a segment "
+                    f"({crossfade_duration}ms > {len(segment)}ms)"
+                )
+        tones, synced_silence = segments[:-1], segments[-1]
+        self.template = tones[0]
+        self.frame_rate = self.template.frame_rate
+
+        # The first chunk is appended while the song is still in the
+        # silence's own format, so let pydub build it once per tone.
+        start = silence.append(silence, crossfade=crossfade_duration)
+        self.first_chunks = [
+            to_frames(start.append(tone, crossfade=crossfade_duration))
+            for tone in tones
+        ]
+
+        # Every later append is a faded-in head plus an untouched body
+        self.silence_parts = self.split_segment(to_frames(synced_silence))
+        self.tone_parts = [self.split_segment(to_frames(tone)) for tone in tones]
+
+    def split_segment(self, frames):
+        """ Splits a segment into its faded-in crossfade head
+        and the remaining body.
+
+        :type frames: numpy.ndarray
+        :param frames: Frames of the segment to be appended
+
+        :raises: N/A
+
+        :rtype: tuple
+        """
+        if self.crossfade_duration == 0:
+            # append(crossfade=0) adds the segment's data as is
+            return frames[:0], frames
+        head = slice_frames(frames, self.frame_rate, end=self.crossfade_duration)
+        head = fade(head, self.frame_rate, from_gain=crossfade_gain)
+        body = slice_frames(frames, self.frame_rate, start=self.crossfade_duration)
+        return head, body
+
+    def plan(self, num_frames, body):
+        """ Computes which frames an append will replace and
+        write, without touching any audio.
+
+        :type num_frames: int
+        :param num_frames: Current length of the song in frames
+
+        :type body: numpy.ndarray
+        :param body: Body of the segment to be appended
+
+        :raises: ValueError if the song is shorter than the crossfade
+
+        :rtype: tuple
+        """
+        length = length_ms(num_frames, self.frame_rate)
+        if self.crossfade_duration > length:
+            raise ValueError(
+                f"Crossfade is longer than the song "
+                f"({self.crossfade_duration}ms > {length}ms)"
+            )
+        tail_start = parse_position(num_frames, self.frame_rate, -self.crossfade_duration)
+        tail_end = parse_position(num_frames, self.frame_rate, length)
+        num_tail_frames = tail_end - tail_start
+        tail_length = length_ms(num_tail_frames, self.frame_rate)
+        num_faded_frames = int(frame_count(self.frame_rate, tail_length))
+        if tail_length <= 100:
+            num_faded_frames = min(num_faded_frames, num_tail_frames)
+        body_start = tail_start + num_faded_frames
+        return tail_start, tail_end, body_start, body_start + len(body)
+
+    def render(self, sequence):
+        """ Renders a sequence of tone indices into an array
+        of frames.
+
+        :type sequence: list
+        :param sequence: Index of the tone to play in each chunk
+
+        :raises: ValueError if the crossfade is too long
+
+        :rtype: numpy.ndarray
+        """
+        sequence = list(sequence)
+        if not sequence:
+            return to_frames(self.silence).copy()
+
+        first_chunk = self.first_chunks[sequence[0]]
+        appended = []
+        for which_tone in sequence[1:]:
+            appended.extend([self.silence_parts, self.tone_parts[which_tone]])
+        if self.crossfade_duration == 0:
+            # Heads are empty, so every append is just its body
+            return np.concatenate([first_chunk] + [body for head, body in appended])
+
+        # First pass: positions only, so the buffer is allocated once
+        num_frames = len(first_chunk)
+        max_frames = num_frames
+        plans = []
+        for head, body in appended:
+            this_plan = self.plan(num_frames, body)
+            plans.append(this_plan)
+            num_frames = this_plan[-1]
+            max_frames = max(max_frames, this_plan[1], num_frames)
+
+        song = np.zeros((max_frames, first_chunk.shape[1]), dtype=first_chunk.dtype)
+        song[: len(first_chunk)] = first_chunk
+        num_frames = len(first_chunk)
+
+        # Second pass: only the crossfade and the new body are written
+        for (head, body), (tail_start, tail_end, body_start, end) in zip(
+            appended, plans
+        ):
+            tail = song[tail_start:tail_end].copy()
+            tail[max(num_frames - tail_start, 0) :] = 0  # silence past the end
+            tail = fade(tail, self.frame_rate, to_gain=crossfade_gain)
+            song[tail_start:body_start] = overlay_looped(tail, head)
+            song[body_start:end] = body
+            num_frames = end
+
+        return song[:num_frames]
+
+    def assemble(self, sequence):
+        """ Renders a sequence of tone indices into an AudioSegment.
+
+        :type sequence: list
+        :param sequence: Index of the tone to play in each chunk
+
+        :raises: ValueError if the crossfade is too long
+
+        :rtype: pydub.AudioSegment
+        """
+        sequence = list(sequence)
+        if not sequence:
+            return self.silence
+        return self.template._spawn(self.render(sequence).tobytes())
@@ -0,0 +1,293 @@
+# Content-addressed cache for generated stimuli.
+#
+# Each stimulus is keyed on a hash of everything that determines
+# its bytes: the source audio, chunk size, crossfade, silence,
+# export parameters and tone sequence. Stimuli whose key hasn't
+# changed are skipped, and stimuli rendered before (e.g., by an
+# earlier cell of a parameter sweep) are copied from the cache
+# instead of being rendered and encoded again. Decoded source
+# audio is cached as WAV files too.
+
+from pydub import AudioSegment
+import hashlib
+import json
+import os
+import shutil
+import wave
+
+
+def segment_hash(segment):
+    """ Hashes the format and samples of an AudioSegment.
+
+    :type segment: pydub.AudioSegment
+    :param segment: Audio segment to hash
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        f"{segment.frame_rate}_{segment.sample_width}_{segment.channels}".encode()
+    )
+    digest.update(segment.raw_data)
+    return digest.hexdigest()
+
+
+def file_hash(file_name):
+    """ Hashes the contents of a file.
+
+    :type file_name: string
+    :param file_name: Path of the file
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def params_hash(params):
+    """ Hashes a JSON-serializable collection of parameters.
+
+    :type params: dict
+    :param params: Parameters to hash
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def stimulus_key(
+    source_hashes, chunk_size, crossfade_duration, silence, export_params, sequence
+):
+    """ Computes the cache key of a single stimulus.
+
+    :type source_hashes: list
+    :param source_hashes: segment_hash of each tone's source audio
+
+    :type chunk_size: int
+    :param chunk_size: Duration of each tone in ms
+
+    :type crossfade_duration: int
+    :param crossfade_duration: Crossfade between segments in ms
+
+    :type silence: pydub.AudioSegment
+    :param silence: Silence inserted between tones
+
+    :type export_params: dict
+    :param export_params: Keyword arguments for AudioSegment.export
+
+    :type sequence: list
+    :param sequence: Index of the tone played in each chunk
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    return params_hash(
+        {
+            "sources": list(source_hashes),
+            "chunk_size": chunk_size,
+            "crossfade_duration": crossfade_duration,
+            "silence_duration": len(silence),
+            "silence": segment_hash(silence),
+            "export_params": export_params,
+            "sequence": "".join(str(int(tone)) for tone in sequence),
+        }
+    )
+
+
+def write_wav(segment, file_name):
+    """ Writes an AudioSegment to a WAV file without ffmpeg.
+
+    :type segment: pydub.AudioSegment
+    :param segment: Audio segment to write
+
+    :type file_name: string
+    :param file_name: Path of the WAV file
+
+    :raises: N/A
+
+    :rtype: void
+    """
+    with wave.open(file_name, "wb") as wav_file:
+        wav_file.setnchannels(segment.channels)
+        wav_file.setsampwidth(segment.sample_width)
+        wav_file.setframerate(segment.frame_rate)
+        wav_file.writeframes(segment.raw_data)
+
+
+def read_wav(file_name):
+    """ Reads a WAV file into an AudioSegment without ffmpeg.
+
+    :type file_name: string
+    :param file_name: Path of the WAV file
+
+    :raises: N/A
+
+    :rtype: pydub.AudioSegment
+    """
+    with wave.open(file_name, "rb") as wav_file:
+        return AudioSegment(
+            data=wav_file.readframes(wav_file.getnframes()),
+            sample_width=wav_file.getsampwidth(),
+            frame_rate=wav_file.getframerate(),
+            channels=wav_file.getnchannels(),
+        )
+
+
+class StimulusCache:
+    """ On-disk, content-addressed store of stimuli and source audio.
+
+    Cached files live under `<cache_dir>/objects/`, named by their key.
+    `<cache_dir>/index.json` records the key each output file was last
+    written with, so unchanged outputs can be skipped outright.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :type cache_dir: string
+        :param cache_dir: Directory to keep the cache in
+
+        :raises: N/A
+        """
+        self.cache_dir = cache_dir
+        self.index_file_name = os.path.join(cache_dir, "index.json")
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        try:
+            with open(self.index_file_name, "r") as fp:
+                self.index = json.load(fp)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def object_path(self, key, extension):
+        """ Path of the cached object with the given key.
+
+        :type key: string
+        :param key: Cache key
+
+        :type extension: string
+        :param extension: File extension (e.g., "mp3")
+
+        :raises: N/A
+
+        :rtype: string
+        """
+        return os.path.join(self.cache_dir, "objects", key[:2], f"{key}.{extension}")
+
+    def is_current(self, file_name, key):
+        """ Whether file_name exists and was last written with key.
+
+        :type file_name: string
+        :param file_name: Path of the output file
+
+        :type key: string
+        :param key: Cache key
+
+        :raises: N/A
+
+        :rtype: bool
+        """
+        return self.index.get(file_name) == key and os.path.exists(file_name)
+
+    def store(self, key, file_name, extension):
+        """ Copies a freshly rendered output into the cache and
+        records it in the index.
+
+        :type key: string
+        :param key: Cache key
+
+        :type file_name: string
+        :param file_name: Path of the output file
+
+        :type extension: string
+        :param extension: File extension of the output
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        object_path = self.object_path(key, extension)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        shutil.copyfile(file_name, object_path)
+        self.record(file_name, key)
+
+    def restore(self, key, file_name, extension):
+        """ Copies a cached object to file_name, if it exists.
+
+        :type key: string
+        :param key: Cache key
+
+        :type file_name: string
+        :param file_name: Path of the output file
+
+        :type extension: string
+        :param extension: File extension of the output
+
+        :raises: N/A
+
+        :rtype: bool
+        """
+        object_path = self.object_path(key, extension)
+        if not os.path.exists(object_path):
+            return False
+        shutil.copyfile(object_path, file_name)
+        self.record(file_name, key)
+        return True
+
+    def record(self, file_name, key):
+        """ Records the key an output file was written with.
+
+        :type file_name: string
+        :param file_name: Path of the output file
+
+        :type key: string
+        :param key: Cache key
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        self.index[file_name] = key
+
+    def save_index(self):
+        """ Writes the index to disk.
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        temp_file_name = f"{self.index_file_name}.tmp"
+        with open(temp_file_name, "w") as fp:
+            json.dump(self.index, fp, indent=1, sort_keys=True)
+        os.replace(temp_file_name, self.index_file_name)
+
+    def load_audio(self, file_name, load=AudioSegment.from_file):
+        """ Decodes an audio file, reusing the decoded samples from
+        an earlier run if the file hasn't changed.
+
+        :type file_name: string
+        :param file_name: Path of the audio file (e.g., an MP3)
+
+        :type load: function
+        :param load: Decodes a path into an AudioSegment on a cache miss
+
+        :raises: N/A
+
+        :rtype: pydub.AudioSegment
+        """
+        object_path = self.object_path(file_hash(file_name), "wav")
+        if os.path.exists(object_path):
+            return read_wav(object_path)
+        segment = load(file_name)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        write_wav(segment, object_path)
+        return segment
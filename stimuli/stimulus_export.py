@@ -0,0 +1,180 @@
+# Output formats for generated stimuli.
+#
+# MP3 encoding dominates generation time, and the experiment has to
+# decode every MP3 again at startup. Besides MP3, stimuli can be
+# written as raw PCM (.npy), WAV or FLAC, and a manifest next to
+# them records which format (and sample layout) each one uses.
+
+from pydub import AudioSegment
+from song_assembly import to_frames
+from stimulus_cache import read_wav, write_wav
+import json
+import numpy as np
+import os
+
+try:
+    import soundfile
+except ImportError:
+    # FLAC falls back to ffmpeg via pydub
+    soundfile = None
+
+output_formats = ["mp3", "wav", "flac", "npy"]
+manifest_name = "manifest.json"
+
+
+def export_song(song, file_name, output_format="mp3", bitrate="192k"):
+    """ Writes a song in the given output format.
+
+    :type song: pydub.AudioSegment
+    :param song: Song to write
+
+    :type file_name: string
+    :param file_name: Path to write to, including its extension
+
+    :type output_format: string
+    :param output_format: One of output_formats
+
+    :type bitrate: string
+    :param bitrate: MP3 bitrate
+
+    :raises: ValueError if the format is unknown
+
+    :rtype: void
+    """
+    if output_format == "mp3":
+        song.export(file_name, format="mp3", bitrate=bitrate)
+    elif output_format == "wav":
+        write_wav(song, file_name)
+    elif output_format == "flac":
+        if soundfile is not None and song.sample_width == 2:
+            soundfile.write(file_name, to_frames(song), song.frame_rate, subtype="PCM_16")
+        else:
+            song.export(file_name, format="flac")
+    elif output_format == "npy":
+        np.save(file_name, to_frames(song))
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+
+def load_song(file_name, entry=None):
+    """ Reads a song written by export_song.
+
+    :type file_name: string
+    :param file_name: Path of the song
+
+    :type entry: dict
+    :param entry: The song's manifest entry (required for .npy files,
+        which don't store their frame rate)
+
+    :raises: ValueError if a .npy file has no manifest entry
+
+    :rtype: pydub.AudioSegment
+    """
+    output_format = os.path.splitext(file_name)[1][1:]
+    if output_format == "npy":
+        if entry is None:
+            raise ValueError(f"{file_name} needs its manifest entry to be read")
+        frames = np.load(file_name)
+        return AudioSegment(
+            data=frames.tobytes(),
+            sample_width=frames.dtype.itemsize,
+            frame_rate=entry["frame_rate"],
+            channels=frames.shape[1],
+        )
+    elif output_format == "wav":
+        return read_wav(file_name)
+    return AudioSegment.from_file(file_name, format=output_format)
+
+
+def manifest_entry(song, output_format, **info):
+    """ Describes a written song for the manifest.
+
+    :type song: pydub.AudioSegment
+    :param song: Song that was written (or any segment in its format)
+
+    :type output_format: string
+    :param output_format: Format it was written in
+
+    :type info: dict
+    :param info: Anything else to record (e.g., switch rate, sequence)
+
+    :raises: N/A
+
+    :rtype: dict
+    """
+    entry = {
+        "format": output_format,
+        "frame_rate": song.frame_rate,
+        "channels": song.channels,
+        "sample_width": song.sample_width,
+    }
+    entry.update(info)
+    return entry
+
+
+def read_manifest(path_prefix):
+    """ Reads the manifest of a stimulus directory.
+
+    :type path_prefix: string
+    :param path_prefix: Stimulus directory (with trailing slash)
+
+    :raises: N/A
+
+    :rtype: dict
+    """
+    try:
+        with open(f"{path_prefix}{manifest_name}", "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def manifest_song_name(path_prefix, stem, manifest, default_format="mp3"):
+    """ Path of a song in whichever format the manifest records for it.
+    Songs missing from the manifest are assumed to be in the default
+    format.
+
+    :type path_prefix: string
+    :param path_prefix: Stimulus directory (with trailing slash)
+
+    :type stem: string
+    :param stem: File name of the song without its extension
+
+    :type manifest: dict
+    :param manifest: The directory's manifest, as returned by read_manifest
+
+    :type default_format: string
+    :param default_format: Format of songs missing from the manifest
+
+    :raises: N/A
+
+    :rtype: string
+    """
+    for file_name, entry in manifest.items():
+        if os.path.splitext(file_name)[0] == stem:
+            return f"{path_prefix}{stem}.{entry['format']}"
+    return f"{path_prefix}{stem}.{default_format}"
+
+
+def update_manifest(path_prefix, entries):
+    """ Adds or replaces entries in the manifest of a stimulus
+    directory. Entries are keyed by file name, relative to the
+    directory.
+
+    :type path_prefix: string
+    :param path_prefix: Stimulus directory (with trailing slash)
+
+    :type entries: dict
+    :param entries: Manifest entries keyed by file name
+
+    :raises: N/A
+
+    :rtype: dict
+    """
+    manifest = read_manifest(path_prefix)
+    manifest.update(entries)
+    temp_file_name = f"{path_prefix}{manifest_name}.tmp"
+    with open(temp_file_name, "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(temp_file_name, f"{path_prefix}{manifest_name}")
+    return manifest
@@ -0,0 +1,352 @@
+# Seedable generation of switch sequences.
+#
+# Draws the whole (switch probability x exemplar x chunk) grid of
+# switches in a single NumPy Generator call from a recorded seed,
+# so any stimulus's tone sequence can be regenerated on demand
+# instead of being recovered from its audio file.
+#
+# Independent switch draws let a stimulus's realized switch count
+# drift far from its nominal rate. sample_switches instead proposes
+# large batches of sequences at once and keeps those within
+# tolerance of the rate's expected switch count (and, optionally, of
+# an even balance of C and G), or draws exactly that many switch
+# positions per sequence.
+
+from sequence_bits import SequenceStore, balances, pack, switch_counts, target_switches
+import json
+import numpy as np
+
+
+def draw_switches(switch_probabilities, num_exemplars, num_chunks, seed):
+    """ Draws starting tones and switches for every stimulus at once.
+
+    Each stimulus uses num_chunks + 1 uniform draws: the first picks
+    the starting tone, and each of the rest switches tones when it
+    falls below the switch probability (as in `generate_songs`).
+
+    :type switch_probabilities: list
+    :param switch_probabilities: Switch probabilities to generate
+
+    :type num_exemplars: int
+    :param num_exemplars: Number of exemplars per switch probability
+
+    :type num_chunks: int
+    :param num_chunks: Number of tones per stimulus
+
+    :type seed: int
+    :param seed: Seed for numpy.random.default_rng
+
+    :raises: N/A
+
+    :rtype: tuple
+    """
+    switch_probabilities = np.asarray(switch_probabilities, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    draws = rng.random((len(switch_probabilities), num_exemplars, num_chunks + 1))
+    # round() sends exactly 0.5 to tone 0
+    start_tones = (draws[..., 0] > 0.5).astype(np.uint8)
+    switches = draws[..., 1:] < switch_probabilities[:, np.newaxis, np.newaxis]
+    return start_tones, switches
+
+
+def tone_sequences(start_tones, switches):
+    """ Converts starting tones and switches into tone sequences.
+
+    :type start_tones: numpy.ndarray
+    :param start_tones: Starting tone (0 or 1) of each stimulus
+
+    :type switches: numpy.ndarray
+    :param switches: Boolean switch matrix, with chunks on the last axis
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    num_switches = np.cumsum(switches, axis=-1, dtype=np.int64)
+    return ((start_tones[..., np.newaxis] + num_switches) % 2).astype(np.uint8)
+
+
+def propose_switches(rng, switch_probabilities, num_proposals, num_chunks, method):
+    """ Proposes switches between consecutive chunks for every switch
+    probability at once.
+
+    :type rng: numpy.random.Generator
+    :param rng: Source of random numbers
+
+    :type switch_probabilities: numpy.ndarray
+    :param switch_probabilities: Switch probabilities
+
+    :type num_proposals: int
+    :param num_proposals: Number of proposals per switch probability
+
+    :type num_chunks: int
+    :param num_chunks: Number of tones per stimulus
+
+    :type method: string
+    :param method: "rejection" (independent switches) or "permutation"
+        (exactly the expected number of switches, in random positions)
+
+    :raises: ValueError if the method is unknown
+
+    :rtype: numpy.ndarray
+    """
+    shape = (len(switch_probabilities), num_proposals, num_chunks - 1)
+    if method == "rejection":
+        return rng.random(shape) < switch_probabilities[:, np.newaxis, np.newaxis]
+    if method == "permutation":
+        targets = target_switches(switch_probabilities, num_chunks)
+        ranks = rng.random(shape).argsort(axis=-1).argsort(axis=-1)
+        return ranks < targets[:, np.newaxis, np.newaxis]
+    raise ValueError(f"Unknown sampling method: {method}")
+
+
+def sample_switches(
+    switch_probabilities,
+    num_exemplars,
+    num_chunks,
+    seed,
+    method="rejection",
+    tolerance=0,
+    balance_tolerance=None,
+    start_tones=None,
+    batch_size=4096,
+    max_rounds=1000,
+):
+    """ Starting tones and switches for every stimulus, with realized
+    switch counts within tolerance of each switch probability's
+    expected count. Returned like draw_switches, so the first chunk
+    never switches.
+
+    Proposals for all switch probabilities are drawn, packed and
+    scored together in batches; accepted ones fill the exemplars in
+    order until every switch probability has num_exemplars.
+
+    :type switch_probabilities: list
+    :param switch_probabilities: Switch probabilities to generate
+
+    :type num_exemplars: int
+    :param num_exemplars: Number of exemplars per switch probability
+
+    :type num_chunks: int
+    :param num_chunks: Number of tones per stimulus
+
+    :type seed: int
+    :param seed: Seed for numpy.random.default_rng
+
+    :type method: string
+    :param method: "rejection" or "permutation" (see propose_switches)
+
+    :type tolerance: int
+    :param tolerance: Allowed difference from the expected switch count
+
+    :type balance_tolerance: int
+    :param balance_tolerance: Allowed difference between the numbers of
+        C and G chunks (default: any)
+
+    :type start_tones: int or string
+    :param start_tones: Starting tone of every stimulus, "alternating"
+        (0 for even exemplars, 1 for odd ones) or None (random)
+
+    :type batch_size: int
+    :param batch_size: Proposals per switch probability per round
+
+    :type max_rounds: int
+    :param max_rounds: Rounds to try before giving up
+
+    :raises: ValueError if some switch probability can't be filled
+
+    :rtype: tuple
+    """
+    switch_probabilities = np.asarray(switch_probabilities, dtype=np.float64)
+    num_rates = len(switch_probabilities)
+    rng = np.random.default_rng(seed)
+    targets = target_switches(switch_probabilities, num_chunks)
+    if method == "permutation" and balance_tolerance is None:
+        # Every proposal is accepted, so one round fills the grid
+        batch_size = num_exemplars
+    batch_size = max(batch_size, num_exemplars)
+
+    switches = np.zeros((num_rates, num_exemplars, num_chunks), dtype=bool)
+    filled = np.zeros(num_rates, dtype=np.int64)
+    for _ in range(max_rounds):
+        if (filled == num_exemplars).all():
+            break
+        proposals = np.zeros((num_rates, batch_size, num_chunks), dtype=bool)
+        proposals[..., 1:] = propose_switches(
+            rng, switch_probabilities, batch_size, num_chunks, method
+        )
+        # Starting on C; flipping every tone keeps both scores
+        starts = np.zeros(proposals.shape[:2], dtype=np.uint8)
+        packed = pack(tone_sequences(starts, proposals))
+        counts = switch_counts(packed, num_chunks)
+        accepted = np.abs(counts - targets[:, np.newaxis]) <= tolerance
+        if balance_tolerance is not None:
+            accepted &= np.abs(balances(packed, num_chunks)) <= balance_tolerance
+
+        slots = np.cumsum(accepted, axis=1) - 1 + filled[:, np.newaxis]
+        rates, which = np.nonzero(accepted & (slots < num_exemplars))
+        switches[rates, slots[rates, which]] = proposals[rates, which]
+        filled = np.minimum(filled + accepted.sum(axis=1), num_exemplars)
+    if (filled < num_exemplars).any():
+        missing = switch_probabilities[filled < num_exemplars]
+        raise ValueError(
+            f"Couldn't fill switch probabilities {list(missing)} "
+            f"within tolerance in {max_rounds} rounds"
+        )
+
+    if start_tones is None:
+        start = (rng.random((num_rates, num_exemplars)) > 0.5).astype(np.uint8)
+    elif start_tones == "alternating":
+        start = np.broadcast_to(
+            np.arange(num_exemplars, dtype=np.uint8) % 2, (num_rates, num_exemplars)
+        ).copy()
+    else:
+        start = np.full((num_rates, num_exemplars), start_tones, dtype=np.uint8)
+    return start, switches
+
+
+class SwitchSequences:
+    """ Tone sequences for a full (switch probability x exemplar)
+    grid of stimuli, generated from a single recorded seed.
+    """
+
+    def __init__(
+        self, switch_probabilities, num_exemplars, num_chunks, seed=None, sampling=None
+    ):
+        """
+        :type switch_probabilities: list
+        :param switch_probabilities: Switch probabilities to generate
+
+        :type num_exemplars: int
+        :param num_exemplars: Number of exemplars per switch probability
+
+        :type num_chunks: int
+        :param num_chunks: Number of tones per stimulus
+
+        :type seed: int
+        :param seed: Seed to generate from (default: a fresh, recorded seed)
+
+        :type sampling: dict
+        :param sampling: Keyword arguments of sample_switches (e.g.,
+            {"method": "permutation"}); default: independent switch
+            draws, as in `generate_songs`
+
+        :raises: ValueError if sample_switches can't fill the grid
+        """
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = int(seed)
+        self.switch_probabilities = [float(p) for p in switch_probabilities]
+        self.num_exemplars = num_exemplars
+        self.num_chunks = num_chunks
+        self.sampling = sampling
+        if sampling is None:
+            self.start_tones, self.switches = draw_switches(
+                self.switch_probabilities, num_exemplars, num_chunks, self.seed
+            )
+        else:
+            self.start_tones, self.switches = sample_switches(
+                self.switch_probabilities,
+                num_exemplars,
+                num_chunks,
+                self.seed,
+                **sampling,
+            )
+        self.tones = tone_sequences(self.start_tones, self.switches)
+
+    def sequence(self, rate_index, exemplar):
+        """ Tone sequence of a single stimulus.
+
+        :type rate_index: int
+        :param rate_index: Index of the switch probability
+
+        :type exemplar: int
+        :param exemplar: Exemplar index
+
+        :raises: N/A
+
+        :rtype: numpy.ndarray
+        """
+        return self.tones[rate_index, exemplar]
+
+    def cells(self):
+        """ Lists every (rate index, switch probability, exemplar)
+        cell of the grid.
+
+        :raises: N/A
+
+        :rtype: list
+        """
+        return [
+            (rate_index, switch_probability, exemplar)
+            for rate_index, switch_probability in enumerate(self.switch_probabilities)
+            for exemplar in range(self.num_exemplars)
+        ]
+
+    def store(self):
+        """ Bit-packed sequences of the whole grid, for vectorized
+        statistics (see sequence_bits.py).
+
+        :raises: N/A
+
+        :rtype: sequence_bits.SequenceStore
+        """
+        return SequenceStore.from_tones(self.tones)
+
+    def save(self, file_name):
+        """ Records the seed and parameters (and, for reference, the
+        sequences themselves) to a JSON file.
+
+        :type file_name: string
+        :param file_name: Path of the JSON file
+
+        :raises: N/A
+
+        :rtype: void
+        """
+        info = {
+            "seed": self.seed,
+            "switch_probabilities": self.switch_probabilities,
+            "num_exemplars": self.num_exemplars,
+            "num_chunks": self.num_chunks,
+            "sampling": self.sampling,
+            "sequences": [
+                ["".join(str(tone) for tone in exemplar) for exemplar in rate]
+                for rate in self.tones.tolist()
+            ],
+        }
+        with open(file_name, "w") as fp:
+            json.dump(info, fp, indent=1)
+
+    @classmethod
+    def load(cls, file_name):
+        """ Regenerates the sequences recorded by `save`.
+
+        :type file_name: string
+        :param file_name: Path of the JSON file
+
+        :raises: ValueError if the regenerated sequences differ
+            from the recorded ones
+
+        :rtype: SwitchSequences
+        """
+        with open(file_name, "r") as fp:
+            info = json.load(fp)
+
+        sequences = cls(
+            info["switch_probabilities"],
+            info["num_exemplars"],
+            info["num_chunks"],
+            seed=info["seed"],
+            sampling=info.get("sampling"),
+        )
+        recorded = np.array(
+            [
+                [[int(tone) for tone in exemplar] for exemplar in rate]
+                for rate in info["sequences"]
+            ],
+            dtype=np.uint8,
+        )
+        if not np.array_equal(recorded, sequences.tones):
+            raise ValueError(f"Sequences in {file_name} don't match their seed")
+        return sequences
@@ -0,0 +1,49 @@
+# Checks SongAssembler against the AudioSegment.append chain it
+# replaces.
+#
+# Usage: python -m pytest test_song_assembly.py
+
+from pydub import AudioSegment
+from song_assembly import SongAssembler
+from tone_synthesis import pure_tone
+import pytest
+
+chunk_size = 500  # in ms
+sequences = [[0, 1, 1, 0, 1, 0, 0], [1], []]
+
+
+def append_chain(songs, silence, sequence, crossfade_duration):
+    """ Builds a song the way generate_songs originally did.
+
+    :type songs: list
+    :param songs: AudioSegments for each tone
+
+    :type silence: pydub.AudioSegment
+    :param silence: Silence inserted between tones
+
+    :type sequence: list
+    :param sequence: Index of the tone to play in each chunk
+
+    :type crossfade_duration: int
+    :param crossfade_duration: Crossfade between segments in ms
+
+    :raises: N/A
+
+    :rtype: pydub.AudioSegment
+    """
+    song = silence
+    for which_tone in sequence:
+        song = song.append(silence, crossfade=crossfade_duration)
+        song = song.append(songs[which_tone][:chunk_size], crossfade=crossfade_duration)
+    return song
+
+
+@pytest.mark.parametrize("crossfade_duration", [0, 1, 50])
+@pytest.mark.parametrize("silence_frame_rate", [11025, 44100])
+def test_matches_append_chain(crossfade_duration, silence_frame_rate):
+    songs = [pure_tone(frequency, duration=1000) for frequency in [261.626, 391.995]]
+    silence = AudioSegment.silent(duration=100, frame_rate=silence_frame_rate)
+    assembler = SongAssembler(songs, silence, chunk_size, crossfade_duration)
+    for sequence in sequences:
+        expected = append_chain(songs, silence, sequence, crossfade_duration)
+        assert assembler.assemble(sequence).raw_data == expected.raw_data
@@ -0,0 +1,266 @@
+# Vectorized tone synthesis.
+#
+# Replaces pydub.generators.Sine, which computes one sample at a
+# time in Python, with NumPy versions that emit integer PCM arrays
+# directly: pure tones, harmonic stacks and ADSR envelopes.
+
+from pydub import AudioSegment
+from pydub.utils import db_to_float
+import math
+import numpy as np
+
+# PCM bit depths and their NumPy sample types
+pcm_dtypes = {8: np.int8, 16: np.int16, 32: np.int32}
+
+
+def num_samples(duration, sample_rate):
+    """ Number of samples in a tone, counted as pydub's generators do.
+
+    :type duration: float
+    :param duration: Duration in ms
+
+    :type sample_rate: int
+    :param sample_rate: Sample rate in Hz
+
+    :raises: N/A
+
+    :rtype: int
+    """
+    return int(sample_rate * (duration / 1000.0))
+
+
+def sine(frequency, duration, sample_rate=44100, phase=0.0):
+    """ Samples of a pure tone in [-1, 1].
+
+    :type frequency: float
+    :param frequency: Frequency in Hz
+
+    :type duration: float
+    :param duration: Duration in ms
+
+    :type sample_rate: int
+    :param sample_rate: Sample rate in Hz
+
+    :type phase: float
+    :param phase: Starting phase in radians
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    sine_of = (frequency * 2 * math.pi) / sample_rate
+    return np.sin(sine_of * np.arange(num_samples(duration, sample_rate)) + phase)
+
+
+def harmonic_weights(amplitudes):
+    """ Harmonic amplitudes scaled to sum (in absolute value) to 1, so
+    a tone made from them can't peak above 1.
+
+    :type amplitudes: list
+    :param amplitudes: Relative amplitude of each harmonic
+
+    :raises: ValueError if all amplitudes are 0
+
+    :rtype: numpy.ndarray
+    """
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    total_amplitude = np.abs(amplitudes).sum()
+    if total_amplitude == 0:
+        raise ValueError("At least one harmonic needs a non-zero amplitude")
+    return amplitudes / total_amplitude
+
+
+def harmonic_stack(frequency, amplitudes, duration, sample_rate=44100):
+    """ Samples of a tone with harmonics, normalized so the peak
+    can't exceed 1. amplitudes[k] is the amplitude of harmonic k + 1.
+
+    :type frequency: float
+    :param frequency: Fundamental frequency in Hz
+
+    :type amplitudes: list
+    :param amplitudes: Relative amplitude of each harmonic
+
+    :type duration: float
+    :param duration: Duration in ms
+
+    :type sample_rate: int
+    :param sample_rate: Sample rate in Hz
+
+    :raises: ValueError if all amplitudes are 0
+
+    :rtype: numpy.ndarray
+    """
+    weights = harmonic_weights(amplitudes)
+    harmonics = np.arange(1, len(weights) + 1)[:, np.newaxis]
+    sine_of = (frequency * 2 * math.pi) / sample_rate
+    phases = sine_of * np.arange(num_samples(duration, sample_rate))
+    return (weights[:, np.newaxis] * np.sin(harmonics * phases)).sum(axis=0)
+
+
+def adsr_envelope(
+    num_samples, sample_rate, attack=10, decay=50, sustain_level=0.7, release=50
+):
+    """ Linear attack-decay-sustain-release envelope. Attack, decay
+    and release are shortened proportionally if they don't fit.
+
+    :type num_samples: int
+    :param num_samples: Length of the envelope in samples
+
+    :type sample_rate: int
+    :param sample_rate: Sample rate in Hz
+
+    :type attack: float
+    :param attack: Time to rise from 0 to 1, in ms
+
+    :type decay: float
+    :param decay: Time to fall from 1 to sustain_level, in ms
+
+    :type sustain_level: float
+    :param sustain_level: Level held between decay and release
+
+    :type release: float
+    :param release: Time to fall from sustain_level to 0, in ms
+
+    :raises: N/A
+
+    :rtype: numpy.ndarray
+    """
+    times = np.array([attack, decay, release], dtype=np.float64)
+    lengths = times * sample_rate / 1000.0
+    if lengths.sum() > num_samples:
+        lengths *= num_samples / lengths.sum()
+    attack_end = lengths[0]
+    decay_end = attack_end + lengths[1]
+    release_start = num_samples - lengths[2]
+
+    sample_times = np.arange(num_samples, dtype=np.float64)
+    return np.interp(
+        sample_times,
+        [0, attack_end, decay_end, release_start, num_samples],
+        [0, 1, sustain_level, sustain_level, 0],
+    )
+
+
+def to_pcm(samples, bit_depth=16, volume=0.0):
+    """ Converts samples in [-1, 1] to integer PCM, truncating
+    towards zero like pydub's generators.
+
+    :type samples: numpy.ndarray
+    :param samples: Samples in [-1, 1]
+
+    :type bit_depth: int
+    :param bit_depth: Bits per sample (8, 16 or 32)
+
+    :type volume: float
+    :param volume: Gain in dB
+
+    :raises: ValueError if the bit depth is unsupported
+
+    :rtype: numpy.ndarray
+    """
+    if bit_depth not in pcm_dtypes:
+        raise ValueError(f"Unsupported bit depth: {bit_depth}")
+    maxval = 2 ** (bit_depth - 1) - 1
+    gain = db_to_float(volume)
+    return np.trunc(samples * maxval * gain).astype(pcm_dtypes[bit_depth])
+
+
+def to_audio_segment(pcm, sample_rate=44100):
+    """ Wraps mono PCM samples in an AudioSegment.
+
+    :type pcm: numpy.ndarray
+    :param pcm: Integer samples from to_pcm
+
+    :type sample_rate: int
+    :param sample_rate: Sample rate in Hz
+
+    :raises: N/A
+
+    :rtype: pydub.AudioSegment
+    """
+    return AudioSegment(
+        data=pcm.tobytes(),
+        sample_width=pcm.dtype.itemsize,
+        frame_rate=sample_rate,
+        channels=1,
+    )
+
+
+def pure_tone(frequency, duration, sample_rate=44100, bit_depth=16, volume=0.0):
+    """ A pure tone as an AudioSegment; a drop-in replacement for
+    Sine(frequency, ...).to_audio_segment(duration).
+
+    :type frequency: float
+    :param frequency: Frequency in Hz
+
+    :type duration: float
+    :param duration: Duration in ms
+
+    :type sample_rate: int
+    :param sample_rate: Sample rate in Hz
+
+    :type bit_depth: int
+    :param bit_depth: Bits per sample (8, 16 or 32)
+
+    :type volume: float
+    :param volume: Gain in dB
+
+    :raises: ValueError if the bit depth is unsupported
+
+    :rtype: pydub.AudioSegment
+    """
+    pcm = to_pcm(sine(frequency, duration, sample_rate), bit_depth, volume)
+    return to_audio_segment(pcm, sample_rate)
+
+
+def tone_library(
+    frequencies,
+    duration,
+    sample_rate=44100,
+    bit_depth=16,
+    amplitudes=(1.0,),
+    envelope=None,
+):
+    """ Synthesizes a tone for every frequency in one pass.
+
+    :type frequencies: list
+    :param frequencies: Fundamental frequency of each tone in Hz
+
+    :type duration: float
+    :param duration: Duration of each tone in ms
+
+    :type sample_rate: int
+    :param sample_rate: Sample rate in Hz
+
+    :type bit_depth: int
+    :param bit_depth: Bits per sample (8, 16 or 32)
+
+    :type amplitudes: list
+    :param amplitudes: Relative amplitude of each harmonic
+        (default: a pure tone)
+
+    :type envelope: dict
+    :param envelope: Keyword arguments for adsr_envelope (default: none)
+
+    :raises: ValueError if the bit depth is unsupported or all
+        amplitudes are 0
+
+    :rtype: numpy.ndarray
+    """
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    # Same normalization as harmonic_stack
+    weights = harmonic_weights(amplitudes)
+    harmonics = np.arange(1, len(weights) + 1)
+
+    # (tone, harmonic, sample)
+    sine_of = (frequencies * 2 * math.pi) / sample_rate
+    sample_times = np.arange(num_samples(duration, sample_rate))
+    phases = sine_of[:, np.newaxis] * sample_times
+    samples = np.einsum(
+        "h,hts->ts",
+        weights,
+        np.sin(harmonics[:, np.newaxis, np.newaxis] * phases),
+    )
+    if envelope is not None:
+        samples *= adsr_envelope(len(sample_times), sample_rate, **envelope)
+    return to_pcm(samples, bit_depth)